@@ -39,16 +39,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from random import randrange as rand
-from tetris_utils import *
+from tetris_game import *
 from tetris_reinforcement_learner import TetrisReinforcementLearner
 
-import pygame, sys
+from tetris_checkpoint import load_checkpoint
+
+import argparse, pygame, sys
 
 # The configuration
 cell_size = 18
-cols =      10
-rows =      22
 maxfps =    30
 
 colors = [
@@ -63,65 +62,31 @@ colors = [
 (35,  35,  35) # Helper color for background grid
 ]
 
-# Define the shapes of the single parts
-tetris_shapes = [
-    [[1, 1, 1],
-     [0, 1, 0]],
-
-    [[0, 2, 2],
-     [2, 2, 0]],
-
-    [[3, 3, 0],
-     [0, 3, 3]],
-
-    [[4, 0, 0],
-     [4, 4, 4]],
-
-    [[0, 0, 5],
-     [5, 5, 5]],
-
-    [[6, 6, 6, 6]],
-
-    [[7, 7],
-     [7, 7]]
-]
-
-def remove_row(board, row):
-    del board[row]
-    return [[0 for i in xrange(cols)]] + board
-
-def new_board():
-    board = [ [ 0 for x in xrange(cols) ]
+# The bitboard only knows which cells are filled, so the colors of settled
+# stones are tracked in a separate matrix that is used for drawing only.
+def new_color_board():
+    return [ [ 0 for x in xrange(cols) ]
             for y in xrange(rows) ]
 
-    board += [[ 1 for x in xrange(cols)]]
+def paint_matrix(color_board, shape, offset):
+    off_x, off_y = offset
+    for cx, cy in piece_geometry(shape).cells:
+        color_board[cy+off_y-1][cx+off_x] = shape[cy][cx]
+    return color_board
 
-    # board[21] = [1, 7, 7, 1, 0, 3, 1, 4, 1, 1]
+def remove_color_rows(color_board, rows):
+    kept = [row for y, row in enumerate(color_board) if y not in rows]
+    return [[0 for i in xrange(cols)] for y in rows] + kept
 
-    return board
-
-class TetrisApp(object):
-    def __init__(self):
+class TetrisApp(TetrisGame):
+    def __init__(self, rng=None, pieces=None):
         self.pygame_initted = False
-        self.gameover = True
         self.width = cell_size*(cols+6)
         self.height = cell_size*rows
         self.rlim = cell_size*cols
         self.bground_grid = [[ 8 if x%2==y%2 else 0 for x in xrange(cols)] for y in xrange(rows)]
 
-        self.key_actions = {
-            'ESCAPE':   self.quit,
-            'LEFT':     lambda:self.move(-1),
-            'RIGHT':    lambda:self.move(+1),
-            'DOWN':     lambda:self.drop(True),
-            'UP':       self.rotate_stone,
-            'p':        self.toggle_pause,
-            'SPACE':    self.start_game,
-            'RETURN':   self.insta_drop
-        }
-
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.init_game()
+        TetrisGame.__init__(self, rng, pieces)
 
     def init_pygame(self):
         pygame.init()
@@ -138,25 +103,6 @@ class TetrisApp(object):
         pygame.time.set_timer(pygame.USEREVENT+1, 1000)
         self.pygame_initted = True
 
-    def new_stone(self):
-        self.stone = self.next_stone[:]
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.stone_x = int(cols / 2 - len(self.stone[0])/2)
-        self.stone_y = 0
-
-        if check_collision(self.board,
-                           self.stone,
-                           (self.stone_x, self.stone_y)):
-            self.gameover = True
-
-    def init_game(self):
-        self.board = new_board()
-        self.new_stone()
-        self.level = 1
-        self.score = 0
-        self.lines = 0
-
-
     def disp_msg(self, msg, topleft):
         x,y = topleft
         for line in msg.splitlines():
@@ -198,79 +144,33 @@ class TetrisApp(object):
                             cell_size,
                             cell_size),0)
 
+    def init_game(self):
+        TetrisGame.init_game(self)
+        self.color_board = new_color_board()
+
     def add_cl_lines(self, n):
-        linescores = [0, 40, 100, 300, 1200]
-        self.lines += n
-        self.score += linescores[n] * self.level
-        if self.lines >= self.level*6:
-            self.level += 1
+        level = self.level
+        TetrisGame.add_cl_lines(self, n)
+        if self.level != level:
             newdelay = 1000-50*(self.level-1)
             newdelay = 100 if newdelay < 100 else newdelay
             if self.pygame_initted: pygame.time.set_timer(pygame.USEREVENT+1, newdelay)
 
-    def move(self, delta_x):
-        if not self.gameover and not self.paused:
-            new_x = self.stone_x + delta_x
-
-            if new_x < 0:
-                new_x = 0
-            if new_x >= cols - len(self.stone[0]):
-                new_x = cols - len(self.stone[0])
-            if not check_collision(self.board,
-                                   self.stone,
-                                   (new_x, self.stone_y)):
-                self.stone_x = new_x
     def quit(self):
         self.center_msg("Exiting...")
         pygame.display.update()
         # sys.exit()
 
-    def drop(self, manual):
-        if not self.gameover and not self.paused:
-            self.score += 1 if manual else 0
-            self.stone_y += 1
-            if check_collision(self.board,
-                               self.stone,
-                               (self.stone_x, self.stone_y)):
-                self.board = join_matrixes(
-                  self.board,
-                  self.stone,
-                  (self.stone_x, self.stone_y))
-                self.new_stone()
-                cleared_rows = 0
-                while True:
-                    for i, row in enumerate(self.board[:-1]):
-                        if 0 not in row:
-                            self.board = remove_row(
-                              self.board, i)
-                            cleared_rows += 1
-                            break
-                    else:
-                        break
-                self.add_cl_lines(cleared_rows)
-                return True
-        return False
-
-    def insta_drop(self):
-        if not self.gameover and not self.paused:
-            while(not self.drop(True)):
-                pass
-
-    def rotate_stone(self):
-        if not self.gameover and not self.paused:
-            new_stone = rotate_clockwise(self.stone)
-            if not check_collision(self.board,
-                                   new_stone,
-                                   (self.stone_x, self.stone_y)):
-                self.stone = new_stone
-
-    def toggle_pause(self):
-        self.paused = not self.paused
-
-    def start_game(self):
-        if self.gameover:
-            self.init_game()
-            self.gameover = False
+    def join_stone(self):
+        self.color_board = paint_matrix(
+          self.color_board,
+          self.stone,
+          (self.stone_x, self.stone_y))
+        TetrisGame.join_stone(self)
+
+    def clear_rows(self, rows):
+        self.color_board = remove_color_rows(self.color_board, rows)
+        TetrisGame.clear_rows(self, rows)
 
     def display_board(self):
         self.screen.fill((0,0,0))
@@ -293,28 +193,13 @@ Press space to continue""" % self.score)
 \nLines: %d" % (self.score, self.level, self.lines),
                     (self.rlim+cell_size, cell_size*5))
                 self.draw_matrix(self.bground_grid, (0,0))
-                self.draw_matrix(self.board, (0,0))
+                self.draw_matrix(self.color_board, (0,0))
                 self.draw_matrix(self.stone,
                     (self.stone_x, self.stone_y))
                 self.draw_matrix(self.next_stone,
                     (cols+1,2))
         pygame.display.update()
 
-    def play_action_sequence(self, action_sequence):
-        for action in action_sequence:
-            if action == 'CONTINUE': break
-            self.key_actions[action]()
-
-        self.insta_drop()
-
-    def update(self, reinforcement_learner, state_before_action, action_sequence):
-        state_after_action = reinforcement_learner.capture_state_attributes(self)
-
-        change_in_pile_height = reinforcement_learner.get_pile_height(state_after_action) - reinforcement_learner.get_pile_height(state_before_action)
-        reward = -1 * change_in_pile_height
-
-        if not self.gameover: reinforcement_learner.update(state_before_action, action_sequence, state_after_action, reward)
-
     def run(self, reinforcement_learner, show_board):
         self.gameover = False
         self.paused = False
@@ -324,14 +209,15 @@ Press space to continue""" % self.score)
                 dont_burn_my_cpu = pygame.time.Clock()
                 if not self.pygame_initted: self.init_pygame()
 
-                self.display_board()
+                if reinforcement_learner:
+                    phase_start = reinforcement_learner.stats.start()
+                    self.display_board()
+                    reinforcement_learner.stats.stop("render", phase_start)
+                else:
+                    self.display_board()
 
             if reinforcement_learner:
-                state_before_action = reinforcement_learner.capture_state_attributes(self)
-                action_sequence = reinforcement_learner.get_action_sequence(state_before_action)
-                if action_sequence == None: return
-                self.play_action_sequence(action_sequence)
-                self.update(reinforcement_learner, state_before_action, action_sequence)
+                if not self.step(reinforcement_learner): return
 
             else:
                 for event in pygame.event.get():
@@ -347,14 +233,21 @@ Press space to continue""" % self.score)
 
             if show_board: dont_burn_my_cpu.tick(maxfps)
 
-def play(computer_player=True):
+# With a checkpoint the AI plays with its saved weights right away instead
+# of training first
+def play(computer_player=True, checkpoint=None):
     App = TetrisApp()
 
     if computer_player:
         reinforcement_learner = TetrisReinforcementLearner(App)
+        if checkpoint: load_checkpoint(checkpoint, reinforcement_learner, play_only=True)
         reinforcement_learner.train()
     else:
         App.run(False, True)
 
-if __name__ == '__main__': play(True)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Watch the tetris AI play")
+    parser.add_argument("--checkpoint", metavar="PATH",
+        help="play with the weights saved in PATH")
+    play(True, parser.parse_args().checkpoint)
 
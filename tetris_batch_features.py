@@ -0,0 +1,55 @@
+import numpy as np
+
+# Batched versions of the board features in TetrisReinforcementLearner. The
+# scalar methods there stay the reference implementation; these work on a
+# stack of N boards at once as an (N, rows, cols) array of filled squares,
+# leaving out the floor row.
+
+def boards_to_cells(boards):
+    rows = np.array(boards, dtype=np.int64)
+    cols = int(rows[0, -1]).bit_length()
+    cells = (rows[:, :-1, np.newaxis] >> np.arange(cols)) & 1
+    return cells.astype(bool)
+
+def get_column_heights(cells):
+    board_height = cells.shape[1]
+    top_rows = np.argmax(cells, axis=1)
+    return np.where(cells.any(axis=1), board_height - top_rows, 0)
+
+def get_pile_heights(column_heights):
+    return column_heights.max(axis=1)
+
+def get_holes(cells):
+    covered = np.maximum.accumulate(cells, axis=1)
+    return (covered & ~cells).sum(axis=(1, 2))
+
+def get_contours(column_heights):
+    return np.abs(np.diff(column_heights, axis=1)).sum(axis=1)
+
+def get_board_features(boards):
+    cells = boards_to_cells(boards)
+    column_heights = get_column_heights(cells)
+
+    return (get_pile_heights(column_heights),
+            get_holes(cells),
+            get_contours(column_heights))
+
+# The features extract_features_for computes
+feature_names = frozenset(["CHANGE_IN_PILE_HEIGHT", "CHANGE_IN_HOLES", "CHANGE_IN_CONTOURS"])
+
+def extract_features(board, successor_boards):
+    return extract_features_for([board], successor_boards, 0)
+
+# The features of successors of several boards at once, where owners[i] is
+# the index in boards of the board successor i came from
+def extract_features_for(boards, successor_boards, owners):
+    old_pile_heights, old_holes, old_contours = get_board_features(boards)
+    new_pile_heights, new_holes, new_contours = get_board_features(successor_boards)
+
+    features = {
+        "CHANGE_IN_PILE_HEIGHT": new_pile_heights - old_pile_heights[owners],
+        "CHANGE_IN_HOLES": new_holes - old_holes[owners],
+        "CHANGE_IN_CONTOURS": new_contours - old_contours[owners]
+    }
+
+    return features
@@ -0,0 +1,237 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+# Benchmarks of the simulation and search hot paths. The positions are
+# captured from a headless game with fixed weights and a piece stream from
+# --seed, so every run times the same boards. Each case reports operations
+# per second and percentiles of the time per operation, and the results can
+# be saved as JSON and compared against an earlier run. The correctness
+# checks run first and the benchmark stops if any of them fails, so a faster
+# backend has to give the same answers to count.
+#
+# Run `python tetris_benchmark.py --output after.json --baseline before.json`.
+
+from tetris_game import TetrisGame, generate_pieces
+from tetris_reinforcement_learner import TetrisReinforcementLearner
+from tetris_utils import *
+
+import argparse, json, platform, random, sys, timeit
+import tetris_batch_features
+
+benchmark_weights = {
+    "CHANGE_IN_PILE_HEIGHT": -0.35,
+    "CHANGE_IN_HOLES": -0.06,
+    "CHANGE_IN_CONTOURS": -0.09
+}
+
+def new_game(seed, placements):
+    rng = random.Random(seed)
+    game = TetrisGame(rng, generate_pieces(placements + 2, seed))
+    reinforcement_learner = TetrisReinforcementLearner(game)
+    reinforcement_learner.rng = rng
+    reinforcement_learner.show_board = False
+    reinforcement_learner.set_named_weights(benchmark_weights)
+    reinforcement_learner.alpha = 0
+
+    game.start_game()
+    game.paused = False
+    return game, reinforcement_learner
+
+# The states the learner sees while playing count moves, starting over
+# whenever the game is lost
+def capture_states(seed, count):
+    game, reinforcement_learner = new_game(seed, count)
+    states = []
+
+    while len(states) < count:
+        state = reinforcement_learner.capture_state_attributes(game)
+        if not game.step(reinforcement_learner):
+            game.start_game()
+            continue
+        states.append(state)
+
+    return states
+
+def fresh_state(state):
+    state = dict(state)
+    state.pop("search_entry", None)
+    return state
+
+# A game set up at the state, to compare against the learner's model. It
+# deals only the first shape so it never touches the global random module.
+def game_at(state):
+    game = TetrisGame(pieces=[0])
+    game.gameover = False
+    game.paused = False
+    game.board = state["board"]
+    game.stone = state["stone"]
+    game.next_stone = state["next_stone"]
+    game.stone_x = state["stone_x"]
+    game.stone_y = state["stone_y"]
+    return game
+
+def check_correctness(states, reinforcement_learner):
+    failures = []
+
+    for index, state in enumerate(states):
+        successor_boards = []
+
+        for placement in reinforcement_learner.get_legal_placements(state):
+            successor = reinforcement_learner.place_stone(state, placement)
+            successor_boards.append(successor["board"])
+
+            if successor["profile"] != get_board_profile(successor["board"]):
+                failures.append("profile of state {0} placement {1}".format(index, placement))
+
+            features = reinforcement_learner.get_feature_dict(reinforcement_learner.extract_features(state, successor))
+            reference = {
+                "CHANGE_IN_PILE_HEIGHT": reinforcement_learner.get_pile_height(successor) - reinforcement_learner.get_pile_height(state),
+                "CHANGE_IN_HOLES": reinforcement_learner.get_holes(successor) - reinforcement_learner.get_holes(state),
+                "CHANGE_IN_CONTOURS": reinforcement_learner.get_contours(successor) - reinforcement_learner.get_contours(state)
+            }
+            if features != reference:
+                failures.append("features of state {0} placement {1}".format(index, placement))
+
+            keys = game_at(state)
+            keys.replay_placement(placement)
+            if keys.board != successor["board"]:
+                failures.append("key replay of state {0} placement {1}".format(index, placement))
+
+            direct = game_at(state)
+            direct.apply_placement(placement_rotations(placement), placement_column(placement))
+            if (direct.board, direct.score, direct.lines, direct.gameover) != (keys.board, keys.score, keys.lines, keys.gameover):
+                failures.append("apply_placement of state {0} placement {1}".format(index, placement))
+
+        batch_features = tetris_batch_features.extract_features(state["board"], successor_boards)
+        for feature, values in batch_features.iteritems():
+            for successor_board, value in zip(successor_boards, values):
+                successor = {"board": successor_board}
+                features = reinforcement_learner.extract_features(state, successor)
+                if value != reinforcement_learner.get_feature_dict(features)[feature]:
+                    failures.append("batch {0} of state {1}".format(feature, index))
+
+    return failures
+
+def percentile(sorted_times, fraction):
+    return sorted_times[min(int(len(sorted_times) * fraction), len(sorted_times) - 1)]
+
+# Times operation(argument) once per argument, rounds times over. The
+# percentiles are of single calls, in microseconds.
+def time_operation(operation, arguments, rounds, prepare=None):
+    timer = timeit.default_timer
+    times = []
+
+    for round_index in xrange(rounds):
+        for argument in arguments:
+            if prepare: argument = prepare(argument)
+            start = timer()
+            operation(argument)
+            times.append(timer() - start)
+
+    times.sort()
+    return {
+        "ops": len(times),
+        "ops_per_second": len(times) / sum(times),
+        "p50_us": percentile(times, 0.5) * 1e6,
+        "p90_us": percentile(times, 0.9) * 1e6,
+        "p99_us": percentile(times, 0.99) * 1e6,
+        "max_us": times[-1] * 1e6
+    }
+
+def time_game(seed, placements):
+    game, reinforcement_learner = new_game(seed, placements)
+    return time_operation(lambda game: game.step(reinforcement_learner) or game.start_game(),
+                          [game] * placements, 1)
+
+def run_benchmarks(seed, state_count, rounds, game_placements):
+    states = capture_states(seed, state_count)
+    game, reinforcement_learner = new_game(seed, 0)
+
+    failures = check_correctness(states, reinforcement_learner)
+    if failures:
+        return None, failures
+
+    placed = [(state, placement) for state in states
+              for placement in reinforcement_learner.get_legal_placements(state)]
+    successors = [(state, reinforcement_learner.place_stone(state, placement))
+                  for state, placement in placed]
+
+    # Each stone where its last drop collides, which is where it is joined
+    landings = []
+    for state, placement in placed:
+        stone = rotated_shape(state["stone"], placement_rotations(placement))
+        x = placement_column(placement)
+        y = fall_row(state["board"], piece_geometry(stone).masks, x, state["stone_y"])
+        landings.append((state["board"], stone, (x, y + 1)))
+
+    def search(state):
+        reinforcement_learner.transposition_table.clear()
+        return reinforcement_learner.get_placement(state)
+
+    results = {
+        "check_collision": time_operation(lambda args: check_collision(*args), landings, rounds),
+        "join_matrixes": time_operation(lambda args: join_matrixes(*args), landings, rounds),
+        "rotate_clockwise": time_operation(rotate_clockwise, [state["stone"] for state in states], rounds),
+        "place_stone": time_operation(lambda args: reinforcement_learner.place_stone(*args), placed, rounds),
+        "extract_features": time_operation(lambda args: reinforcement_learner.extract_features(*args), successors, rounds),
+        "get_legal_placements": time_operation(reinforcement_learner.get_legal_placements, states, rounds),
+        "get_placement": time_operation(search, states, 1, fresh_state),
+        "headless_game": time_game(seed, game_placements)
+    }
+    return results, []
+
+def print_results(results, baseline=None):
+    print "{0:<22}{1:>14}{2:>10}{3:>10}{4:>10}{5:>10}".format(
+        "case", "ops/s", "p50 us", "p90 us", "p99 us", "speedup")
+
+    for case in sorted(results):
+        result = results[case]
+        speedup = ""
+        if baseline and case in baseline:
+            speedup = "{0:.2f}x".format(result["ops_per_second"] / baseline[case]["ops_per_second"])
+
+        print "{0:<22}{1:>14.1f}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10}".format(
+            case, result["ops_per_second"], result["p50_us"],
+            result["p90_us"], result["p99_us"], speedup)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the tetris simulation and search")
+    parser.add_argument("--seed", type=int, default=1,
+        help="seed for the piece stream the positions come from")
+    parser.add_argument("--states", type=int, default=200,
+        help="number of positions to time the operations on")
+    parser.add_argument("--rounds", type=int, default=5,
+        help="how often to time every operation on every position")
+    parser.add_argument("--game-placements", type=int, default=500,
+        help="moves in the end-to-end headless game")
+    parser.add_argument("--output",
+        help="save the results as JSON to this file")
+    parser.add_argument("--baseline",
+        help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    results, failures = run_benchmarks(args.seed, args.states, args.rounds, args.game_placements)
+    if failures:
+        print "Correctness checks failed:"
+        for failure in failures:
+            print "  " + failure
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({
+                "seed": args.seed,
+                "states": args.states,
+                "rounds": args.rounds,
+                "game_placements": args.game_placements,
+                "python": platform.python_version(),
+                "results": results
+            }, output_file, indent=2, sort_keys=True)
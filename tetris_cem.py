@@ -0,0 +1,257 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+# Finds feature weights with the cross-entropy method instead of TD
+# learning. Every generation samples a population of weight vectors from a
+# Gaussian per feature and scores each one by the lines it clears in the same
+# seeded headless games, played by a TetrisReinforcementLearner that only
+# searches, so the features and the placement search are the learner's own.
+# The Gaussian is then refit to the elite, the best scoring part of the
+# population, with some extra noise that fades out over the generations.
+#
+# The candidates are scored in a process pool. Each one plays its games from
+# the generation's seeds, so a run gives the same weights for a given seed
+# whatever the number of workers. Games stop after max_placements moves or
+# once the pile is give_up_height high, and a candidate whose first game
+# clears fewer lines than cutoff_fraction of the last elite threshold plays
+# no more games. Every generation is checkpointed, and --resume carries on
+# from the checkpoint.
+#
+# Run `python tetris_cem.py --generations 20 --population 50 --workers 8 --seed 1`.
+
+from multiprocessing import Pool
+from tetris_checkpoint import save_checkpoint, write_json
+from tetris_features import feature_registry
+from tetris_game import TetrisGame, generate_pieces
+from tetris_reinforcement_learner import TetrisReinforcementLearner, feature_names
+
+import argparse, json, random
+import numpy as np
+
+cem_checkpoint_version = 1
+
+def game_seed(seed, generation, game_index):
+    return (seed * 1000003 + generation) * 1000003 + game_index
+
+# Lines cleared in one game dealt from seed by a learner that does not learn
+def play_game(reinforcement_learner, seed, max_placements, give_up_height):
+    rng = random.Random(seed)
+    game = TetrisGame(rng, generate_pieces(max_placements + 2, seed))
+    reinforcement_learner.tetris_game = game
+    reinforcement_learner.rng = rng
+    game.start_game()
+    game.paused = False
+
+    for placement_index in xrange(max_placements):
+        state = reinforcement_learner.capture_state_attributes(game)
+        if state["profile"].pile_height >= give_up_height: break
+
+        placement = reinforcement_learner.get_placement(state)
+        if placement is None: break
+        game.play_placement(placement)
+
+    return game.lines
+
+# The lines cleared in each game a candidate got to play. Runs in the pool,
+# so it takes one tuple of arguments.
+def evaluate_weights(arguments):
+    names, weights, seeds, settings = arguments
+
+    reinforcement_learner = TetrisReinforcementLearner(None)
+    reinforcement_learner.show_board = False
+    reinforcement_learner.search_depth = settings["search_depth"]
+    reinforcement_learner.use_features(names)
+    reinforcement_learner.weights = np.array(weights)
+    reinforcement_learner.weights_changed()
+
+    lines = []
+    for seed in seeds:
+        lines.append(play_game(reinforcement_learner, seed,
+                               settings["max_placements"], settings["give_up_height"]))
+        if lines[0] < settings["cutoff"]: break
+
+    return lines
+
+class CrossEntropyTrainer(object):
+    def __init__(self, feature_names=feature_names, workers=4, seed=0):
+        self.feature_names = tuple(feature_names)
+        self.workers = workers
+        self.seed = seed
+
+        self.population = 50
+        # The part of the population the distribution is refit to
+        self.elite_fraction = 0.2
+        self.games = 3
+        self.max_placements = 1000
+        self.give_up_height = 20
+        self.cutoff_fraction = 0.5
+        # Stones the search looks ahead while scoring (see
+        # TetrisReinforcementLearner.search_depth)
+        self.search_depth = 1
+        # Variance added to every feature's after each refit, falling by
+        # noise_decay per generation, so the distribution does not collapse
+        # too early
+        self.noise = 0.1
+        self.noise_decay = 0.01
+
+        self.random_state = np.random.RandomState(seed)
+        self.mean = np.zeros(len(self.feature_names))
+        self.std = np.ones(len(self.feature_names))
+        self.generation = 0
+        self.cutoff = 0
+        self.best_weights = self.mean.tolist()
+        self.best_score = None
+        self.history = []
+
+    # Samples, scores and refits one generation. Returns the mean lines of
+    # every candidate.
+    def run_generation(self, pool=None):
+        candidates = self.random_state.normal(self.mean, self.std, (self.population, len(self.mean)))
+        settings = {
+            "search_depth": self.search_depth,
+            "max_placements": self.max_placements,
+            "give_up_height": self.give_up_height,
+            "cutoff": self.cutoff
+        }
+        seeds = [game_seed(self.seed, self.generation, game_index) for game_index in xrange(self.games)]
+        arguments = [(self.feature_names, candidate.tolist(), seeds, settings) for candidate in candidates]
+
+        results = (pool.map if pool else map)(evaluate_weights, arguments)
+        scores = np.array([float(sum(lines)) / len(lines) for lines in results])
+
+        # A stable sort keeps ties in sampling order
+        elite_count = max(int(round(self.population * self.elite_fraction)), 1)
+        elite = np.argsort(-scores, kind="mergesort")[:elite_count]
+        noise = max(self.noise - self.noise_decay * self.generation, 0)
+        self.mean = candidates[elite].mean(axis=0)
+        self.std = np.sqrt(candidates[elite].var(axis=0) + noise)
+        self.cutoff = self.cutoff_fraction * scores[elite[-1]]
+
+        if self.best_score is None or scores[elite[0]] > self.best_score:
+            self.best_score = float(scores[elite[0]])
+            self.best_weights = candidates[elite[0]].tolist()
+
+        self.history.append({
+            "generation": self.generation,
+            "mean_score": float(scores.mean()),
+            "elite_score": float(scores[elite].mean()),
+            "best_score": float(scores[elite[0]]),
+            "games_played": sum(len(lines) for lines in results)
+        })
+        self.generation += 1
+        return scores
+
+    def print_generation(self):
+        result = self.history[-1]
+        print "Generation {0}: mean {1:.1f} lines, elite {2:.1f}, best {3:.1f} ({4} games)".format(
+            result["generation"], result["mean_score"], result["elite_score"],
+            result["best_score"], result["games_played"])
+        for feature, mean, std in zip(self.feature_names, self.mean, self.std):
+            print "{0}: {1} +- {2}".format(feature, mean, std)
+        print ""
+
+    def train(self, generations, checkpoint=None):
+        pool = Pool(self.workers) if self.workers > 1 else None
+        try:
+            while self.generation < generations:
+                self.run_generation(pool)
+                self.print_generation()
+                if checkpoint: self.save(checkpoint)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    def save(self, path):
+        name, keys, position, has_gauss, cached_gaussian = self.random_state.get_state()
+        write_json(path, {
+            "version": cem_checkpoint_version,
+            "feature_names": list(self.feature_names),
+            "generation": self.generation,
+            "mean": self.mean.tolist(),
+            "std": self.std.tolist(),
+            "cutoff": self.cutoff,
+            "best_weights": self.best_weights,
+            "best_score": self.best_score,
+            "history": self.history,
+            "random_state": [name, keys.tolist(), position, has_gauss, cached_gaussian]
+        })
+
+    def load(self, path):
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+
+        if checkpoint.get("version") != cem_checkpoint_version:
+            raise ValueError("{0} is not a version {1} CEM checkpoint".format(path, cem_checkpoint_version))
+
+        self.feature_names = tuple(str(feature) for feature in checkpoint["feature_names"])
+        self.generation = checkpoint["generation"]
+        self.mean = np.array(checkpoint["mean"])
+        self.std = np.array(checkpoint["std"])
+        self.cutoff = checkpoint["cutoff"]
+        self.best_weights = checkpoint["best_weights"]
+        self.best_score = checkpoint["best_score"]
+        self.history = checkpoint["history"]
+
+        name, keys, position, has_gauss, cached_gaussian = checkpoint["random_state"]
+        self.random_state.set_state((str(name), np.array(keys, dtype=np.uint32),
+                                     position, has_gauss, cached_gaussian))
+
+    # A learner playing with the distribution's mean weights, to save as a
+    # learner checkpoint for tetris.py --checkpoint
+    def get_learner(self):
+        reinforcement_learner = TetrisReinforcementLearner(None)
+        reinforcement_learner.use_features(self.feature_names)
+        reinforcement_learner.weights = self.mean.copy()
+        reinforcement_learner.weights_changed()
+        return reinforcement_learner
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Search for the tetris AI's weights with the cross-entropy method")
+    parser.add_argument("--generations", type=int, default=20,
+        help="number of generations")
+    parser.add_argument("--population", type=int, default=50,
+        help="weight vectors sampled per generation")
+    parser.add_argument("--elite-fraction", type=float, default=0.2,
+        help="part of the population the distribution is refit to")
+    parser.add_argument("--games", type=int, default=3,
+        help="games each weight vector is scored on")
+    parser.add_argument("--max-placements", type=int, default=1000,
+        help="moves after which a game is stopped")
+    parser.add_argument("--give-up-height", type=int, default=20,
+        help="pile height at which a game is given up")
+    parser.add_argument("--cutoff-fraction", type=float, default=0.5,
+        help="skip the other games of a candidate whose first game clears fewer lines than this part of the last elite threshold")
+    parser.add_argument("--search-depth", type=int, default=1,
+        help="stones the search looks ahead")
+    parser.add_argument("--features", nargs="+", default=list(feature_names),
+        choices=sorted(feature_registry), metavar="FEATURE",
+        help="features to weigh, from tetris_features")
+    parser.add_argument("--workers", type=int, default=4,
+        help="number of worker processes")
+    parser.add_argument("--seed", type=int, default=0,
+        help="seed for the sampling and the games")
+    parser.add_argument("--checkpoint", metavar="PATH",
+        help="save the search after every generation to PATH")
+    parser.add_argument("--resume", action="store_true",
+        help="continue the search from --checkpoint")
+    parser.add_argument("--save-weights", metavar="PATH",
+        help="save the final mean weights as a learner checkpoint for tetris.py --checkpoint")
+    args = parser.parse_args()
+
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+
+    trainer = CrossEntropyTrainer(args.features, args.workers, args.seed)
+    trainer.population = args.population
+    trainer.elite_fraction = args.elite_fraction
+    trainer.games = args.games
+    trainer.max_placements = args.max_placements
+    trainer.give_up_height = args.give_up_height
+    trainer.cutoff_fraction = args.cutoff_fraction
+    trainer.search_depth = args.search_depth
+    if args.resume: trainer.load(args.checkpoint)
+
+    trainer.train(args.generations, args.checkpoint)
+    if args.save_weights: save_checkpoint(args.save_weights, trainer.get_learner())
@@ -0,0 +1,108 @@
+from tetris_utils import tetris_shapes
+
+import json, os, tempfile
+
+# Checkpoints of a TetrisReinforcementLearner: its weights, the alpha and
+# epsilon schedule, the episode counter and the state of its random number
+# generator (and the game's, if that is a separate one, its place in the
+# piece stream and the next stone it has already dealt), as compact JSON.
+# A checkpoint is written to a temporary file next to the target and then
+# renamed over it, so a crash while saving leaves the last one intact.
+checkpoint_version = 1
+
+def rng_state(rng):
+    version, internal_state, gauss_next = rng.getstate()
+    return [version, list(internal_state), gauss_next]
+
+def set_rng_state(rng, state):
+    version, internal_state, gauss_next = state
+    rng.setstate((version, tuple(internal_state), gauss_next))
+
+def save_checkpoint(path, reinforcement_learner):
+    game = reinforcement_learner.tetris_game
+    checkpoint = {
+        "version": checkpoint_version,
+        "feature_names": list(reinforcement_learner.feature_names),
+        "weights": reinforcement_learner.get_named_weights(),
+        "current_episode": reinforcement_learner.current_episode,
+        "episodes_to_train": reinforcement_learner.episodes_to_train,
+        "initial_alpha": reinforcement_learner.initial_alpha,
+        "alpha": reinforcement_learner.alpha,
+        "initial_epsilon": reinforcement_learner.initial_epsilon,
+        "epsilon": reinforcement_learner.epsilon,
+        "discount": reinforcement_learner.discount,
+        "rng_state": rng_state(reinforcement_learner.rng)
+    }
+    if game is not None:
+        checkpoint["piece_index"] = game.piece_index
+        checkpoint["next_stone"] = tetris_shapes.index(game.next_stone)
+        if game.rng is not reinforcement_learner.rng:
+            checkpoint["game_rng_state"] = rng_state(game.rng)
+
+    write_json(path, checkpoint)
+
+# Writes data as JSON to a temporary file next to path and renames it over
+# path, so readers only ever see a complete file
+def write_json(path, data):
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(prefix=".checkpoint-", dir=directory)
+    try:
+        with os.fdopen(handle, "w") as checkpoint_file:
+            json.dump(data, checkpoint_file, separators=(",", ":"), sort_keys=True)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        replace_file(temporary_path, path)
+    except:
+        if os.path.exists(temporary_path): os.remove(temporary_path)
+        raise
+
+# os.rename replaces the target atomically on POSIX but refuses to on
+# Windows
+def replace_file(source, target):
+    try:
+        os.rename(source, target)
+    except OSError:
+        os.remove(target)
+        os.rename(source, target)
+
+# Restores a learner from a checkpoint so training carries on where it
+# stopped. The learner keeps its own episodes_to_train, so a resumed run can
+# train for longer (or shorter) than the one that was saved; when the target
+# changed, alpha and epsilon are put where the schedule has them for the new
+# one. With play_only only the weights are loaded and the learner is put
+# straight past training, with learning and exploration off.
+def load_checkpoint(path, reinforcement_learner, play_only=False):
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    if checkpoint.get("version") != checkpoint_version:
+        raise ValueError("{0} is not a version {1} checkpoint".format(path, checkpoint_version))
+
+    weights = dict((str(feature), weight) for feature, weight in checkpoint["weights"].iteritems())
+    feature_names = [str(feature) for feature in
+                     checkpoint.get("feature_names", reinforcement_learner.feature_names)]
+    reinforcement_learner.use_features(feature_names)
+    reinforcement_learner.set_named_weights(weights)
+
+    if play_only:
+        reinforcement_learner.current_episode = reinforcement_learner.episodes_to_train
+        reinforcement_learner.alpha = 0
+        reinforcement_learner.epsilon = 0
+        return
+
+    for attribute in ("current_episode", "initial_alpha", "alpha",
+                      "initial_epsilon", "epsilon", "discount"):
+        setattr(reinforcement_learner, attribute, checkpoint[attribute])
+    if checkpoint["episodes_to_train"] != reinforcement_learner.episodes_to_train:
+        reinforcement_learner.reset_schedule()
+
+    set_rng_state(reinforcement_learner.rng, checkpoint["rng_state"])
+    game = reinforcement_learner.tetris_game
+    if game is not None:
+        game.piece_index = checkpoint.get("piece_index", 0)
+        # The game dealt its next stone when it was made, before the stream
+        # and the rng were restored
+        if "next_stone" in checkpoint:
+            game.next_stone = tetris_shapes[checkpoint["next_stone"]]
+        if "game_rng_state" in checkpoint:
+            set_rng_state(game.rng, checkpoint["game_rng_state"])
@@ -0,0 +1,107 @@
+from collections import namedtuple
+
+from tetris_utils import *
+
+# The features the learner can build its Q-values from, by name. Each one is
+# computed from the board summaries of a state and its successor, and names
+# the intermediates of the summaries it reads. The column ones come from the
+# board profile, which drop_shape keeps up to date as stones land; the rest
+# are filled in by one top-down pass over the board's rows, which computes
+# only what the features in use need. Register a feature with
+# register_feature and put its name in the learner's feature_names.
+Feature = namedtuple("Feature", "name needs compute")
+
+BoardSummary = namedtuple("BoardSummary", BoardProfile._fields +
+    ("row_fills", "hole_map", "row_transitions", "cleared_rows"))
+
+profile_intermediates = frozenset(BoardProfile._fields)
+
+feature_registry = {}
+
+def register_feature(name, needs, compute):
+    feature_registry[name] = Feature(name, frozenset(needs), compute)
+
+# Which intermediates the named features need, all together
+def feature_needs(names):
+    return frozenset().union(*(feature_registry[name].needs for name in names))
+
+# The filled squares of every row, the holes of every row as a mask (empty
+# squares with a filled one somewhere above) and the filled/empty changes
+# along the rows of the pile, walls counting as filled, in one pass from the
+# top. Intermediates that are not needed are None.
+def scan_board(board, needs):
+    want_fills = "row_fills" in needs
+    want_hole_map = "hole_map" in needs
+    want_transitions = "row_transitions" in needs
+
+    cols = board_width(board)
+    walls = 1 | 1 << (cols + 1)
+    inside = (1 << (cols + 1)) - 1
+
+    row_fills = [] if want_fills else None
+    hole_map = [] if want_hole_map else None
+    row_transitions = 0 if want_transitions else None
+    covered = 0
+
+    for row in board[:-1]:
+        if want_fills: row_fills.append(count_cells(row))
+        if want_hole_map: hole_map.append(covered & ~row)
+        covered |= row
+
+        if want_transitions and covered:
+            squares = row << 1 | walls
+            row_transitions += count_cells((squares ^ squares >> 1) & inside)
+
+    return (tuple(row_fills) if want_fills else None,
+            tuple(hole_map) if want_hole_map else None,
+            row_transitions)
+
+# The profile itself when that has everything needed
+def summarize(board, profile, cleared_rows, needs):
+    if needs <= profile_intermediates:
+        return profile
+    return BoardSummary(*(profile + scan_board(board, needs) + (cleared_rows,)))
+
+# The change in one intermediate that is a number, by position because that
+# is faster than by name
+def difference(intermediate):
+    index = BoardSummary._fields.index(intermediate)
+    return lambda old, new: new[index] - old[index]
+
+# Depth of every column below both its neighbours, the walls counting as
+# infinitely high
+def wells(column_heights):
+    wall = float("inf")
+    total = 0
+    last = len(column_heights) - 1
+
+    for x, height in enumerate(column_heights):
+        left = column_heights[x - 1] if x > 0 else wall
+        right = column_heights[x + 1] if x < last else wall
+        total += max(min(left, right) - height, 0)
+
+    return total
+
+def height_weighted_cells(row_fills):
+    board_height = len(row_fills)
+    return sum((board_height - y) * fills for y, fills in enumerate(row_fills))
+
+def rows_with_holes(hole_map):
+    return sum(1 for holes in hole_map if holes)
+
+register_feature("CHANGE_IN_PILE_HEIGHT", ["pile_height"],
+    difference("pile_height"))
+register_feature("CHANGE_IN_HOLES", ["holes"],
+    difference("holes"))
+register_feature("CHANGE_IN_CONTOURS", ["contours"],
+    difference("contours"))
+register_feature("CHANGE_IN_WELLS", ["column_heights"],
+    lambda old, new: wells(new.column_heights) - wells(old.column_heights))
+register_feature("CHANGE_IN_ROW_TRANSITIONS", ["row_transitions"],
+    difference("row_transitions"))
+register_feature("CHANGE_IN_ROWS_WITH_HOLES", ["hole_map"],
+    lambda old, new: rows_with_holes(new.hole_map) - rows_with_holes(old.hole_map))
+register_feature("CHANGE_IN_HEIGHT_WEIGHTED_CELLS", ["row_fills"],
+    lambda old, new: height_weighted_cells(new.row_fills) - height_weighted_cells(old.row_fills))
+register_feature("LINES_CLEARED", ["cleared_rows"],
+    difference("cleared_rows"))
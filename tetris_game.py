@@ -0,0 +1,332 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+# The game rules of tetris.py without any pygame, so the learner can play as
+# fast as the CPU allows. TetrisApp in tetris.py draws on top of this.
+#
+# Run `python tetris_game.py --episodes 100` to train without a display.
+
+# Copyright (c) 2010 "Kevin Chabowski"<kevin@kch42.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from array import array
+from tetris_utils import *
+from tetris_reinforcement_learner import TetrisReinforcementLearner
+from tetris_replay import ReplayBuffer
+from tetris_checkpoint import load_checkpoint
+from tetris_stats import profile_run
+
+import argparse, random, time
+
+# The configuration
+cols =      10
+rows =      22
+
+def new_board():
+    return empty_board(cols, rows)
+
+# A piece stream is the stones a game deals as indices into tetris_shapes,
+# stored one byte per stone, so several runs can face exactly the same game
+def generate_pieces(count, seed):
+    rng = random.Random(seed)
+    return array('B', (rng.randrange(len(tetris_shapes)) for i in xrange(count)))
+
+def save_pieces(path, pieces):
+    with open(path, 'wb') as piece_file:
+        pieces.tofile(piece_file)
+
+def load_pieces(path):
+    pieces = array('B')
+    with open(path, 'rb') as piece_file:
+        pieces.fromstring(piece_file.read())
+    return pieces
+
+class TetrisGame(object):
+    # Stones come from rng (the global random module by default) unless a
+    # piece stream is given, which is dealt in order and starts over once
+    # it runs out. Neither is reset when a new game starts.
+    def __init__(self, rng=None, pieces=None):
+        self.gameover = True
+        self.total_moves = 0
+        self.start_time = time.time()
+        self.rng = rng or random
+        self.pieces = pieces
+        self.piece_index = 0
+
+        self.key_actions = {
+            'ESCAPE':   self.quit,
+            'LEFT':     lambda:self.move(-1),
+            'RIGHT':    lambda:self.move(+1),
+            'DOWN':     lambda:self.drop(True),
+            'UP':       self.rotate_stone,
+            'p':        self.toggle_pause,
+            'SPACE':    self.start_game,
+            'RETURN':   self.insta_drop
+        }
+
+        self.next_stone = self.deal_stone()
+        self.init_game()
+
+    def deal_stone(self):
+        if self.pieces is None:
+            return tetris_shapes[self.rng.randrange(len(tetris_shapes))]
+
+        piece = self.pieces[self.piece_index % len(self.pieces)]
+        self.piece_index += 1
+        return tetris_shapes[piece]
+
+    def new_stone(self):
+        self.stone = self.next_stone[:]
+        self.next_stone = self.deal_stone()
+        self.stone_x = int(cols / 2 - len(self.stone[0])/2)
+        self.stone_y = 0
+
+        if check_collision(self.board,
+                           self.stone,
+                           (self.stone_x, self.stone_y)):
+            self.gameover = True
+
+    def init_game(self):
+        self.board = new_board()
+        self.new_stone()
+        self.level = 1
+        self.score = 0
+        self.lines = 0
+
+    def add_cl_lines(self, n):
+        linescores = [0, 40, 100, 300, 1200]
+        self.lines += n
+        self.score += linescores[n] * self.level
+        if self.lines >= self.level*6:
+            self.level += 1
+
+    def move(self, delta_x):
+        if not self.gameover and not self.paused:
+            new_x = self.stone_x + delta_x
+
+            if new_x < 0:
+                new_x = 0
+            if new_x >= cols - len(self.stone[0]):
+                new_x = cols - len(self.stone[0])
+            if not check_collision(self.board,
+                                   self.stone,
+                                   (new_x, self.stone_y)):
+                self.stone_x = new_x
+
+    def quit(self):
+        pass
+
+    def join_stone(self):
+        self.board = join_matrixes(
+          self.board,
+          self.stone,
+          (self.stone_x, self.stone_y))
+
+    def clear_rows(self, rows):
+        self.board = remove_rows(self.board, rows)
+
+    def drop(self, manual):
+        if not self.gameover and not self.paused:
+            self.score += 1 if manual else 0
+            self.stone_y += 1
+            if check_collision(self.board,
+                               self.stone,
+                               (self.stone_x, self.stone_y)):
+                self.join_stone()
+                self.new_stone()
+                cleared_rows = full_rows(self.board)
+                self.clear_rows(cleared_rows)
+                self.add_cl_lines(len(cleared_rows))
+                return True
+        return False
+
+    # Puts the stone down at a rotation and column in one step: the landing
+    # row comes straight from the column tops (unless the stone is under an
+    # overhang) and only the rows the stone lands on can fill up. Board,
+    # score, lines and level end up exactly as rotating, moving and
+    # insta-dropping with the keys would leave them, so the column has to be
+    # one the keys can reach (see get_placements).
+    def apply_placement(self, rotation, column):
+        if self.gameover or self.paused: return
+
+        self.stone = rotated_shape(self.stone, rotation)
+        self.stone_x = column
+        piece = piece_geometry(self.stone)
+        landing_y = landing_row(column_tops(self.board), piece.bottoms, column)
+        if landing_y < self.stone_y:
+            landing_y = fall_row(self.board, piece.masks, column, self.stone_y)
+
+        # insta_drop scores a point for every drop, the landing one included,
+        # and joins the stone one row above where that drop collided
+        self.score += landing_y - self.stone_y + 1
+        self.stone_y = landing_y + 1
+        self.join_stone()
+        self.new_stone()
+
+        full = self.board[-1]
+        cleared_rows = [y for y in xrange(landing_y, landing_y + len(piece.masks))
+                        if self.board[y] == full]
+        if cleared_rows: self.clear_rows(cleared_rows)
+        self.add_cl_lines(len(cleared_rows))
+
+    def insta_drop(self):
+        if not self.gameover and not self.paused:
+            while(not self.drop(True)):
+                pass
+
+    def rotate_stone(self):
+        if not self.gameover and not self.paused:
+            new_stone = rotate_clockwise(self.stone)
+            if not check_collision(self.board,
+                                   new_stone,
+                                   (self.stone_x, self.stone_y)):
+                self.stone = new_stone
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+
+    def start_game(self):
+        if self.gameover:
+            self.init_game()
+            self.gameover = False
+
+    def moves_per_second(self):
+        return self.total_moves / (time.time() - self.start_time)
+
+    def play_placement(self, placement):
+        self.apply_placement(placement_rotations(placement),
+                             placement_column(placement))
+        self.total_moves += 1
+
+    # Plays a placement the slow way a player would, with key presses
+    def replay_placement(self, placement):
+        for action in placement_actions(placement, self.stone_x):
+            self.key_actions[action]()
+
+        self.insta_drop()
+        self.total_moves += 1
+
+    def update(self, reinforcement_learner, state_before_action, placement):
+        state_after_action = reinforcement_learner.capture_state_attributes(self)
+
+        change_in_pile_height = reinforcement_learner.get_pile_height(state_after_action) - reinforcement_learner.get_pile_height(state_before_action)
+        reward = -1 * change_in_pile_height
+
+        reinforcement_learner.update(state_before_action, placement, state_after_action, reward)
+
+    # Lets the learner make one move. Returns False once it stops playing.
+    def step(self, reinforcement_learner):
+        state_before_action = reinforcement_learner.capture_state_attributes(self)
+        placement = reinforcement_learner.get_placement(state_before_action)
+        if placement == None: return False
+        self.play_placement(placement)
+        self.update(reinforcement_learner, state_before_action, placement)
+        reinforcement_learner.stats.placement_done(reinforcement_learner)
+        return True
+
+    # There is nothing to show without pygame, show_board only matters for
+    # TetrisApp
+    def run(self, reinforcement_learner, show_board=False):
+        self.gameover = False
+        self.paused = False
+
+        while self.step(reinforcement_learner):
+            pass
+
+# With a checkpoint path the learner is checkpointed every checkpoint_every
+# episodes and when it is done. resume carries on from that checkpoint, and
+# play_only loads just its weights and plays episodes games without
+# learning.
+def train(episodes, seed=None, pieces=None, stats=None, stats_every=100, profile=None,
+          checkpoint=None, checkpoint_every=1, resume=False, play_only=False,
+          replay_capacity=0, replay_file=None, prioritized_replay=False):
+    rng = random.Random(seed) if seed is not None else None
+    game = TetrisGame(rng, pieces)
+    reinforcement_learner = TetrisReinforcementLearner(game)
+    if rng: reinforcement_learner.rng = rng
+    if stats: reinforcement_learner.stats.export_to(stats, stats_every)
+    reinforcement_learner.show_board = False
+    reinforcement_learner.episodes_to_train = episodes
+    reinforcement_learner.episodes_to_display = 0
+
+    if play_only:
+        load_checkpoint(checkpoint, reinforcement_learner, play_only=True)
+        reinforcement_learner.episodes_to_display = episodes - 1
+    else:
+        if resume: load_checkpoint(checkpoint, reinforcement_learner)
+        reinforcement_learner.checkpoint_path = checkpoint
+        reinforcement_learner.checkpoint_every = checkpoint_every
+
+    if replay_capacity:
+        reinforcement_learner.replay_buffer = ReplayBuffer(
+            replay_capacity, reinforcement_learner.feature_names, replay_file, prioritized_replay, seed=seed)
+
+    if profile:
+        profile_run(profile, reinforcement_learner.train)
+    else:
+        reinforcement_learner.train()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Train the tetris AI without a display")
+    parser.add_argument("--episodes", type=int, default=20,
+        help="number of training episodes")
+    parser.add_argument("--seed", type=int,
+        help="seed for the stones and the move order")
+    parser.add_argument("--pieces",
+        help="deal the stones from this piece file")
+    parser.add_argument("--record-pieces", metavar="PATH",
+        help="write --piece-count stones from --seed to PATH and exit")
+    parser.add_argument("--piece-count", type=int, default=100000,
+        help="number of stones to record")
+    parser.add_argument("--stats", metavar="PATH",
+        help="append per-phase timings and search counters to PATH as JSON lines")
+    parser.add_argument("--stats-every", type=int, default=100,
+        help="moves covered by each line of --stats")
+    parser.add_argument("--profile", metavar="PATH",
+        help="run under cProfile and write the profile to PATH")
+    parser.add_argument("--checkpoint", metavar="PATH",
+        help="save the weights and training schedule to PATH")
+    parser.add_argument("--checkpoint-every", type=int, default=1,
+        help="episodes between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+        help="continue training from --checkpoint")
+    parser.add_argument("--play", action="store_true",
+        help="only play --episodes games with the weights in --checkpoint")
+    parser.add_argument("--replay-capacity", type=int, default=0,
+        help="also learn from mini-batches of the last N transitions")
+    parser.add_argument("--replay-file", metavar="PATH",
+        help="keep the replay buffer in a memory-mapped file at PATH")
+    parser.add_argument("--prioritized-replay", action="store_true",
+        help="sample transitions by the size of their last TD error")
+    args = parser.parse_args()
+
+    if (args.resume or args.play) and not args.checkpoint:
+        parser.error("--resume and --play need --checkpoint")
+
+    if args.record_pieces:
+        save_pieces(args.record_pieces, generate_pieces(args.piece_count, args.seed))
+    else:
+        stats = open(args.stats, "a") if args.stats else None
+        train(args.episodes, args.seed,
+              load_pieces(args.pieces) if args.pieces else None,
+              stats, args.stats_every, args.profile,
+              args.checkpoint, args.checkpoint_every, args.resume, args.play,
+              args.replay_capacity, args.replay_file, args.prioritized_replay)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2
+#-*- coding: utf-8 -*-
+
+# Trains one TetrisReinforcementLearner with several headless games at once.
+# Every worker process owns a TetrisGame and a learner sharing one
+# random.Random seeded from the trainer's seed and its own index, or dealing
+# the stones of a piece file from its own offset. Each round the workers get the shared
+# weights, play sync_placements moves while doing their own TD updates and
+# send back how far their weights moved. The deltas are averaged in worker
+# order, so a run is reproducible for a given seed and number of workers.
+# Checkpoints hold the shared learner only: a resumed run's workers start new
+# games from their seeds or offsets again rather than where they stopped.
+#
+# Run `python tetris_parallel.py --workers 16 --episodes 100 --seed 1`.
+
+from multiprocessing import Pipe, Process
+from tetris_checkpoint import load_checkpoint, save_checkpoint
+from tetris_game import TetrisGame, load_pieces
+from tetris_reinforcement_learner import TetrisReinforcementLearner
+
+import argparse, random, time
+import numpy as np
+
+def worker_seed(seed, worker_index):
+    return seed * 1000003 + worker_index
+
+def self_play_worker(connection, seed, worker_index, pieces=None, piece_offset=0):
+    rng = random.Random(worker_seed(seed, worker_index))
+
+    game = TetrisGame(rng, pieces)
+    game.piece_index = piece_offset
+    reinforcement_learner = TetrisReinforcementLearner(game)
+    reinforcement_learner.rng = rng
+    reinforcement_learner.show_board = False
+    game.start_game()
+    game.paused = False
+
+    while True:
+        message = connection.recv()
+        if message is None: break
+
+        feature_names, weights, alpha, placements = message
+        if feature_names != reinforcement_learner.feature_names:
+            reinforcement_learner.use_features(feature_names)
+        reinforcement_learner.weights = weights.copy()
+        reinforcement_learner.weights_changed()
+        reinforcement_learner.alpha = alpha
+        finished_games = []
+
+        played = 0
+        while played < placements:
+            if game.step(reinforcement_learner):
+                played += 1
+            else:
+                finished_games.append((game.score, game.lines))
+                game.start_game()
+
+        connection.send((reinforcement_learner.weights - weights, finished_games))
+
+    connection.close()
+
+class ParallelTrainer(object):
+    def __init__(self, reinforcement_learner, workers=4, seed=0, sync_placements=50, pieces=None):
+        self.reinforcement_learner = reinforcement_learner
+        self.workers = workers
+        self.seed = seed
+        self.sync_placements = sync_placements
+        self.pieces = pieces
+        self.connections = []
+        self.processes = []
+
+    def start(self):
+        for worker_index in xrange(self.workers):
+            connection, worker_connection = Pipe()
+            piece_offset = worker_index * len(self.pieces) // self.workers if self.pieces else 0
+            process = Process(target=self_play_worker,
+                              args=(worker_connection, self.seed, worker_index,
+                                    self.pieces, piece_offset))
+            process.daemon = True
+            process.start()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def stop(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+
+        self.connections = []
+        self.processes = []
+
+    # Plays sync_placements moves in every worker and merges the weights.
+    # Returns the (score, lines) of every game that finished, in worker order.
+    def train_round(self):
+        learner = self.reinforcement_learner
+        message = (learner.feature_names, learner.weights, learner.alpha, self.sync_placements)
+
+        for connection in self.connections:
+            connection.send(message)
+        results = [connection.recv() for connection in self.connections]
+
+        total_delta = np.zeros(len(learner.weights))
+        for deltas, finished_games in results:
+            total_delta += deltas
+        learner.weights = learner.weights + total_delta / self.workers
+        learner.weights_changed()
+
+        return [game for deltas, finished_games in results for game in finished_games]
+
+    def train(self):
+        learner = self.reinforcement_learner
+        start_time = time.time()
+        placements = 0
+
+        self.start()
+        try:
+            while learner.current_episode < learner.episodes_to_train:
+                finished_games = self.train_round()
+                placements += self.workers * self.sync_placements
+
+                for score, lines in finished_games:
+                    learner.update_schedule()
+                    print "After {0} episodes, score is {1}".format(learner.current_episode, score)
+                    print "{0} lines cleared".format(lines)
+                    learner.save_checkpoint_if_due()
+
+                if finished_games:
+                    print "{0:.1f} moves per second".format(placements / (time.time() - start_time))
+                    learner.print_weights()
+        finally:
+            self.stop()
+            if learner.checkpoint_path: save_checkpoint(learner.checkpoint_path, learner)
+
+def train(episodes, workers, seed, sync_placements, pieces=None,
+          checkpoint=None, checkpoint_every=1, resume=False):
+    reinforcement_learner = TetrisReinforcementLearner(None)
+    reinforcement_learner.episodes_to_train = episodes
+    if resume: load_checkpoint(checkpoint, reinforcement_learner)
+    reinforcement_learner.checkpoint_path = checkpoint
+    reinforcement_learner.checkpoint_every = checkpoint_every
+
+    ParallelTrainer(reinforcement_learner, workers, seed, sync_placements, pieces).train()
+    reinforcement_learner.print_weights()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Train the tetris AI with several games in parallel")
+    parser.add_argument("--episodes", type=int, default=20,
+        help="number of training episodes over all workers")
+    parser.add_argument("--workers", type=int, default=4,
+        help="number of worker processes")
+    parser.add_argument("--seed", type=int, default=0,
+        help="seed for the workers' stone and move order")
+    parser.add_argument("--sync-placements", type=int, default=50,
+        help="moves each worker plays between weight merges")
+    parser.add_argument("--pieces",
+        help="deal the stones from this piece file")
+    parser.add_argument("--checkpoint", metavar="PATH",
+        help="save the weights and training schedule to PATH")
+    parser.add_argument("--checkpoint-every", type=int, default=1,
+        help="episodes between checkpoints")
+    parser.add_argument("--resume", action="store_true",
+        help="continue training from --checkpoint; the workers' games are not saved, so they start over from --seed")
+    args = parser.parse_args()
+
+    if args.resume and not args.checkpoint:
+        parser.error("--resume needs --checkpoint")
+
+    train(args.episodes, args.workers, args.seed, args.sync_placements,
+          load_pieces(args.pieces) if args.pieces else None,
+          args.checkpoint, args.checkpoint_every, args.resume)
@@ -1,9 +1,19 @@
-import random, sys
-
-from collections import defaultdict
-from copy import deepcopy
+import heapq, random, sys, time
+import numpy as np
+import tetris_batch_features, tetris_features, tetris_vector_env
+
+from itertools import izip
+from operator import itemgetter
+from tetris_checkpoint import save_checkpoint
+from tetris_stats import AgentStats
 from tetris_utils import *
 
+# The features the learner uses unless given others, in a fixed order
+feature_names = ("CHANGE_IN_PILE_HEIGHT", "CHANGE_IN_HOLES", "CHANGE_IN_CONTOURS")
+
+class SearchTimeout(Exception):
+    pass
+
 class TetrisReinforcementLearner:
     def __init__(self, tetris_game):
         self.tetris_game = tetris_game
@@ -11,31 +21,92 @@ class TetrisReinforcementLearner:
         self.episodes_to_display = 5
         self.episodes_to_train = 20
         self.current_episode = 0
-        self.weights = defaultdict(lambda: 0)
+        self.show_board = True
+        # One weight per feature in use, at the feature's index in
+        # feature_names (see use_features)
+        self.feature_names = ()
+        self.weights = np.zeros(0)
+        self.weights_version = 0
         self.discount = 0.9
         self.initial_alpha = 0.005
         self.alpha = self.initial_alpha
         self.initial_epsilon = 0.0
         self.epsilon = self.initial_epsilon
+        # Shuffles the candidate placements; give it its own random.Random
+        # (usually the game's) for runs that can be repeated exactly
+        self.rng = random
+        # How many stones the search looks ahead (the current one included),
+        # how many of each position's best placements it expands further and
+        # how many seconds it may take per move (None for no limit). With a
+        # limit it deepens one stone at a time and keeps the deepest result.
+        self.search_depth = 2
+        self.beam_width = 10
+        self.search_time_budget = None
+        # evaluator(state, successor_states) returns the value of each
+        # successor as seen from state; None uses the Q-values
+        self.evaluator = None
+        # Score candidates with the NumPy batch features instead of the board
+        # profiles, optionally checking every batch against get_state_q_value
+        self.batch_evaluation = False
+        self.check_batch_evaluation = False
+        # Candidate order, successor states, features and Q-values of recently
+        # searched positions, keyed by Zobrist hash, so update() and the next
+        # get_placement() share one search and repeated positions are
+        # not evaluated again
+        self.transposition_table = TranspositionTable(64)
+        # Per-phase timings and search counters, off by default (see
+        # tetris_stats)
+        self.stats = AgentStats()
+        # File to checkpoint the weights and training schedule to (None for
+        # none) every checkpoint_every episodes and on quit (see
+        # tetris_checkpoint)
+        self.checkpoint_path = None
+        self.checkpoint_every = 1
+        # Past transitions to learn from again (a tetris_replay.ReplayBuffer
+        # over feature_names, or None to learn from the latest transition
+        # only) and how many of them every update replays
+        self.replay_buffer = None
+        self.replay_batch_size = 32
+        # The features of tetris_features.feature_registry that Q-values are
+        # built from. The NumPy batch paths only compute the default ones and
+        # fall back to the scalar features for any others.
+        self.use_features(feature_names)
 
     def train(self):
-        self.play()
+        for episode in self.run_episodes():
+            pass
+
+        self.quit()
+
+    # Plays one game per iteration on the same tetris_game, restarting it in
+    # place, and yields the number of finished episodes after each one
+    def run_episodes(self):
+        while self.current_episode <= self.episodes_to_train + self.episodes_to_display:
+            if self.current_episode >= self.episodes_to_train:
+                self.play_trained_game()
+            else:
+                self.play()
+
+            self.next_episode()
+            yield self.current_episode
 
     def play(self):
         self.tetris_game.start_game()
-        self.tetris_game.run(self, True)
+        self.tetris_game.run(self, self.show_board)
 
     def play_trained_game(self):
         self.tetris_game.start_game()
-        self.tetris_game.run(self, True)
+        self.tetris_game.run(self, self.show_board)
 
     def quit(self):
+        if self.checkpoint_path: save_checkpoint(self.checkpoint_path, self)
         self.tetris_game.quit()
         sys.exit()
 
     def capture_state_attributes(self, game):
         return {
-            "board": deepcopy(game.board),
+            "board": game.board,
+            "profile": get_board_profile(game.board),
             "stone": game.stone,
             "next_stone": game.next_stone,
             "stone_x": game.stone_x,
@@ -44,252 +115,406 @@ class TetrisReinforcementLearner:
         }
 
     def print_weights(self):
-        for feature, weight in self.weights.iteritems():
+        for feature, weight in izip(self.feature_names, self.weights):
             print "{0}: {1}".format(feature, weight)
         print ""
 
+    # The weights by feature name, for printing and checkpoints
+    def get_named_weights(self):
+        return dict(izip(self.feature_names, self.weights.tolist()))
+
+    def set_named_weights(self, weights):
+        for feature, weight in weights.iteritems():
+            self.weights[self.feature_index[feature]] = weight
+        self.weights_changed()
+
     def next_episode(self):
-        self.current_episode += 1
-        self.epsilon = self.initial_epsilon * (1 - self.current_episode / self.episodes_to_train)
-        self.alpha = self.alpha - (self.initial_alpha / self.episodes_to_train)
+        self.update_schedule()
 
         print "After {0} episodes, score is {1}".format(self.current_episode, self.tetris_game.score)
         print "{0} lines cleared".format(self.tetris_game.lines)
+        print "{0:.1f} moves per second".format(self.tetris_game.moves_per_second())
+        print "Transposition table: {0} entries, {1:.1%} hit rate".format(len(self.transposition_table), self.transposition_table.hit_rate())
 
         self.print_weights()
+        self.save_checkpoint_if_due()
+
+    def save_checkpoint_if_due(self):
+        if self.checkpoint_path and self.current_episode % self.checkpoint_every == 0:
+            save_checkpoint(self.checkpoint_path, self)
+
+    def update_schedule(self):
+        self.current_episode += 1
+        self.epsilon = self.initial_epsilon * (1 - self.current_episode / self.episodes_to_train)
+        self.alpha = self.alpha - (self.initial_alpha / self.episodes_to_train)
 
-        if self.current_episode > (self.episodes_to_train + self.episodes_to_display):
-            return self.quit()
-        elif self.current_episode >= self.episodes_to_train:
+        if self.current_episode >= self.episodes_to_train:
             self.alpha = 0
             self.epsilon = 0
-            return self.play_trained_game()
-        else:
-            return self.play()
 
-    def move_is_legal(self, delta_x, state):
-        new_x = state['stone_x'] + delta_x
-        cols = len(state['board'][0])
-
-        within_left_border = new_x >= 0
-        within_right_border = new_x <= cols - len(state['stone'][0])
-        collision = check_collision(state['board'],
-                                       state['stone'],
-                                       (new_x, state['stone_y']))
+    # Alpha and epsilon as update_schedule would have left them after
+    # current_episode episodes
+    def reset_schedule(self):
+        self.epsilon = self.initial_epsilon * (1 - self.current_episode / self.episodes_to_train)
+        self.alpha = self.initial_alpha * (1 - float(self.current_episode) / self.episodes_to_train)
 
-        return within_left_border and within_right_border and not collision
+        if self.current_episode >= self.episodes_to_train:
+            self.alpha = 0
+            self.epsilon = 0
 
     def move_to_next_stone(self, state):
         state["stone"] = state["next_stone"]
         state["next_stone"] = None
 
         # reset x and y
-        columns = len(state["board"][0])
+        columns = board_width(state["board"])
         stone_length = len(state["stone"][0])
 
         state["stone_x"] = int(columns / 2 - stone_length / 2)
         state["stone_y"] = 0
 
-    def get_legal_move_sequences(self, state):
-        delta_x = 0
-        legal_move_sequences = []
-
-        while delta_x > -1 * len(state['board'][0]):
-            if self.move_is_legal(delta_x, state):
-                legal_move_sequences.append([delta_x])
-                delta_x -= 1
-            else:
-                break
-
-        delta_x = 1
-
-        while delta_x < len(state['board'][0]):
-            if self.move_is_legal(delta_x, state):
-                legal_move_sequences.append([delta_x])
-                delta_x += 1
-            else:
+    # A stone that cannot move anywhere is dropped where it is
+    def get_legal_placements(self, state):
+        placements = get_placements(state["board"], state["stone"], state["stone_x"], state["stone_y"])
+
+        if not placements: placements = [pack_placement(0, state["stone_x"])]
+        return placements
+
+    # The n best [value, placement] pairs of the placements from state,
+    # valuing their successors against root (state by default). The pairs
+    # stream through a bounded heap, best first, and equal values keep the
+    # order the placements came in.
+    def get_top_n_q_value_pairs(self, state, shuffled_placements, n, root=None):
+        q_value_pairs = self.get_q_value_pairs(state, shuffled_placements, root or state)
+
+        return [list(q_value_pair) for q_value_pair in heapq.nlargest(n, q_value_pairs, key=itemgetter(0))]
+
+    def get_q_value_pairs(self, state, placements, root):
+        if self.evaluator or self.batch_evaluation:
+            # Batch evaluators need all successors at once
+            placements = list(placements)
+            if self.stats.enabled: self.stats.count("candidates_evaluated", len(placements))
+            successor_states = [self.get_placement_successor(state, placement) for placement in placements]
+            for q_value_pair in izip(self.evaluate(root, successor_states), placements):
+                yield q_value_pair
+        else:
+            for placement in placements:
+                if self.stats.enabled: self.stats.count("candidates_evaluated")
+                successor_state = self.get_placement_successor(state, placement)
+                yield (self.get_state_q_value(root, successor_state), placement)
+
+    def get_top_q_value_pair(self, state, placements):
+        if self.search_time_budget is None:
+            return self.search(state, placements, self.search_depth, None)
+
+        deadline = time.time() + self.search_time_budget
+        top_q_value_pair = self.search(state, placements, 1, None)
+
+        for depth in xrange(2, self.search_depth + 1):
+            try:
+                top_q_value_pair = self.search(state, placements, depth, deadline)
+            except SearchTimeout:
                 break
 
-        return legal_move_sequences
-
-    def turn_deltas_to_sequences(self, legal_move_sequences, rotations):
-        sequences = []
-        sequence_start = ["UP"] * rotations
-
-        for delta in legal_move_sequences:
-            if delta == 0:
-                sequences.append(sequence_start + ["CONTINUE"])
-                continue
-
-            direction = "LEFT" if delta < 0 else "RIGHT"
-            sequence = sequence_start + ([direction] * abs(delta))
-            sequences.append(sequence)
-
-        #If you're pinned or creating a row
-        if len(sequences) == 0: sequences = [["CONTINUE"]]
-
-        return sequences
-
-    def get_move_sequences_for_each_rotation(self, state):
-        move_sequences = []
-        current_state = state
-
-        rotations = 0
-        while rotations < 4:
-            move_sequences_at_rotation = self.get_legal_move_sequences(current_state)
-
-            for msar_idx, move_sequence_at_rotation in enumerate(move_sequences_at_rotation):
-                move_sequences_at_rotation[msar_idx] = ["UP"] * rotations + move_sequence_at_rotation
-
-            move_sequences += move_sequences_at_rotation
-            current_state = self.copy_state(current_state)
-            self.rotate(current_state)
-            rotations += 1
-
-        return move_sequences
-
-    def translate_moves_into_actions(self, move_sequences):
-        for ms_idx, move_sequence in enumerate(move_sequences):
-            action_sequence = []
-
-            for move in move_sequence:
-                if isinstance(move, basestring):
-                    action_sequence += [move]
-                    continue
-
-                if move == 0:
-                    action_sequence += ["CONTINUE"]
-                    continue
-
-                direction = "LEFT" if move < 0 else "RIGHT"
-                action_sequence += [direction] * abs(move)
-
-            move_sequences[ms_idx] = action_sequence
-
-        return move_sequences
-
-
-    def get_legal_action_sequences(self, state):
-        move_sequences = self.get_move_sequences_for_each_rotation(state)
-        legal_action_sequences = self.translate_moves_into_actions(move_sequences)
-
-        if not legal_action_sequences: legal_action_sequences = [["CONTINUE"]]
-        return legal_action_sequences
-
-    def square_is_zero(self, square):
-        square == 0
-
-    def prune_action_sequence(self, action_sequence):
-        pruned_action_sequence = []
-
-        for action in action_sequence:
-            if action == "NEXT_STONE": break
-            pruned_action_sequence.append(action)
-
-        return pruned_action_sequence
-
-    def get_top_n_q_value_pairs(self, state, shuffled_action_sequences, n):
-        top_n_q_value_pairs = []
-
-        for action_sequence in shuffled_action_sequences:
-            q_value = self.get_q_value(state, action_sequence)
-
-            if len(top_n_q_value_pairs) < n:
-                top_n_q_value_pairs.append([q_value, action_sequence])
-                top_n_q_value_pairs.sort(key=lambda q_v_p: q_v_p[0], reverse=True)
-            else:
-                if q_value > top_n_q_value_pairs[-1][0]:
-                    top_n_q_value_pairs.append([q_value, action_sequence])
-                    top_n_q_value_pairs.sort(key=lambda q_v_p: q_v_p[0], reverse=True)
-                    top_n_q_value_pairs.pop()
-
-        return top_n_q_value_pairs
-
-    def create_lookahead_sequences(self, state, top_n_q_value_pairs):
-        lookahead_sequences = []
-
-        for q_value_pair in top_n_q_value_pairs:
-            action_sequence = q_value_pair[1]
-            successor_state = self.get_successor_state(state, action_sequence)
-            legal_action_sequences = self.get_legal_action_sequences(successor_state)
-            for legal_action_sequence in legal_action_sequences:
-                lookahead_sequence = action_sequence + ["NEXT_STONE"] + legal_action_sequence
-                lookahead_sequences.append(lookahead_sequence)
-
-        return lookahead_sequences
-
-    def get_top_q_value_pair(self, state, action_sequences):
-        top_5_q_value_pairs = self.get_top_n_q_value_pairs(state, action_sequences, 10)
-        lookahead_sequences = self.create_lookahead_sequences(state, top_5_q_value_pairs)
-        top_lookahead_q_value_pairs = self.get_top_n_q_value_pairs(state, lookahead_sequences, 1)
-
-        return top_lookahead_q_value_pairs[0]
-
-    def split_action_sequence(self, action_sequence):
-        first_stone_action_sequence = []
-        second_stone_action_sequence = []
-
-        current_action_sequence = first_stone_action_sequence
-
-        for action in action_sequence:
-            if action == "NEXT_STONE":
-                current_action_sequence = second_stone_action_sequence
-            else:
-                current_action_sequence.append(action)
-
-        return (first_stone_action_sequence, second_stone_action_sequence)
-
-
-
-    def get_action_sequence(self, state):
-        if state["gameover"]: return self.next_episode()
-
-        legal_action_sequences = self.get_legal_action_sequences(state)
-        shuffled_action_sequences = random.sample(legal_action_sequences, len(legal_action_sequences))
-        top_q_value_pair = self.get_top_q_value_pair(state, shuffled_action_sequences)
-
-        best_action_sequence = top_q_value_pair[1]
-
-        return self.prune_action_sequence(best_action_sequence)
+        return top_q_value_pair
+
+    # Beam search: the best [value, placement] among the placements from
+    # state, looking depth stones ahead. Only the beam_width best placements
+    # of each position are expanded, each from its successor state, and final
+    # positions are valued against root. Raises SearchTimeout once the
+    # deadline has passed.
+    def search(self, state, placements, depth, deadline, root=None):
+        root = root or state
+        phase_start = self.stats.start() if state is root else None
+
+        if depth == 1:
+            top_q_value_pair = self.get_top_n_q_value_pairs(state, placements, 1, root)[0]
+            self.stats.stop("first_ply_scoring", phase_start)
+            return top_q_value_pair
+
+        top_q_value_pair = None
+        top_q_value_pairs = self.get_top_n_q_value_pairs(state, placements, self.beam_width, root)
+        self.stats.stop("first_ply_scoring", phase_start)
+
+        for q_value, placement in top_q_value_pairs:
+            successor_state = self.get_placement_successor(state, placement)
+            phase_start = self.stats.start() if state is root else None
+            value = self.get_expected_value(root, successor_state, depth - 1, deadline)
+            self.stats.stop("lookahead", phase_start)
+
+            if top_q_value_pair is None or value > top_q_value_pair[0]:
+                top_q_value_pair = [value, placement]
+
+        return top_q_value_pair
+
+    # Once the next stone has been used up the stone to place is unknown, so
+    # the value is averaged over every shape it could be
+    def get_expected_value(self, root, state, depth, deadline):
+        if deadline is not None and time.time() > deadline: raise SearchTimeout()
+
+        if state["stone"] is not None:
+            placements = self.get_cached_placements(state)
+            return self.search(state, placements, depth, deadline, root)[0]
+
+        values = [self.get_expected_value(root, self.with_stone(state, shape), depth, deadline) for shape in tetris_shapes]
+        return sum(values) / len(values)
+
+    def with_stone(self, state, shape):
+        state_with_stone = self.copy_state(state)
+        state_with_stone["next_stone"] = shape
+        self.move_to_next_stone(state_with_stone)
+
+        return state_with_stone
+
+    def get_placement(self, state):
+        if state["gameover"]: return None
+
+        top_q_value_pair = self.get_root_q_value_pair(state)
+
+        best_placement = top_q_value_pair[1]
+
+        return best_placement
+
+    # The best placement of every state one stone ahead, with the candidates
+    # of all the states dropped and scored in one NumPy batch. The stones
+    # have to be unrotated, as they are when they spawn. This is how the
+    # games of a tetris_vector_env.VectorTetrisEnv choose their moves, so
+    # the transposition table, which would rarely hit across games, is left
+    # out.
+    def get_placements_batch(self, states):
+        return self.get_best_placements_batch(states)[0]
+
+    # get_placements_batch, also returning the features of every best
+    # placement as the rows of a matrix
+    def get_best_placements_batch(self, states):
+        candidates = []
+        for state in states:
+            placements = self.get_legal_placements(state)
+            candidates.append(self.rng.sample(placements, len(placements)))
+
+        if self.features_batchable:
+            owners = np.repeat(np.arange(len(states)), [len(placements) for placements in candidates])
+            placements = np.array([placement for placements in candidates for placement in placements], dtype=np.int64)
+            boards = np.array([state["board"] for state in states], dtype=np.int64)
+            pieces = np.array([tetris_vector_env.piece_indexes[state["stone"]] for state in states])
+
+            successor_boards, landing_rows, cleared = tetris_vector_env.drop_pieces(
+                boards[owners], pieces[owners], placement_rotations(placements), placement_column(placements))
+            features = self.get_batch_feature_matrix(
+                tetris_batch_features.extract_features_for(boards, successor_boards, owners))
+        else:
+            features = np.array([self.extract_features(state, self.place_stone(state, placement))
+                                 for state, placements in izip(states, candidates)
+                                 for placement in placements]).reshape(-1, len(self.feature_names))
+        q_values = features.dot(self.weights)
+
+        best_placements = []
+        best_rows = []
+        start = 0
+        for placements in candidates:
+            best = int(np.argmax(q_values[start:start + len(placements)]))
+            best_placements.append(placements[best])
+            best_rows.append(start + best)
+            start += len(placements)
+
+        return best_placements, features[best_rows]
 
     def get_max_q_value(self, state):
-        legal_action_sequences = self.get_legal_action_sequences(state)
-        top_q_value_pair = self.get_top_q_value_pair(state, legal_action_sequences)
+        top_q_value_pair = self.get_root_q_value_pair(state)
         max_q_value = top_q_value_pair[0]
 
         return max_q_value
 
-    def get_q_value(self, state, action_sequence):
-        q_value = 0
+    # The result of the full search from state, kept in its transposition
+    # table entry while the weights and the search and evaluation settings
+    # stay the same. update() searches the next state for its TD target, and
+    # when that update learned nothing the next get_placement() uses the same
+    # result instead of searching again.
+    def get_root_q_value_pair(self, state):
+        entry = self.get_search_entry(state)
+        version = (self.weights_version, self.search_depth, self.beam_width, self.search_time_budget,
+                   self.evaluator, self.batch_evaluation)
+
+        if entry["top_version"] != version:
+            entry["top_q_value_pair"] = self.get_top_q_value_pair(state, self.get_shuffled_placements(state))
+            entry["top_version"] = version
+
+        return entry["top_q_value_pair"]
+
+    # With features that read the rows cleared since the search started,
+    # the same position reached after clearing a different number of rows
+    # gets its own entry, as its cached successors carry that count
+    def get_state_key(self, state):
+        state_hash = (self.get_profile(state).zobrist ^
+                      zobrist_stone("stone", state["stone"]) ^
+                      zobrist_stone("next_stone", state["next_stone"]))
+        if "cleared_rows" in self.feature_needs:
+            return (state_hash, state["stone_x"], state["stone_y"], state.get("cleared_rows", 0))
+        return (state_hash, state["stone_x"], state["stone_y"])
+
+    # The transposition table entry of a state. It is remembered on the state
+    # so the table is only consulted once per state.
+    def get_search_entry(self, state):
+        if "search_entry" not in state:
+            key = self.get_state_key(state)
+            entry = self.transposition_table.get(key)
+
+            if entry is None:
+                entry = {"shuffled_placements": None, "placements": None, "successors": {},
+                         "top_q_value_pair": None, "top_version": None}
+                self.transposition_table.put(key, entry)
+
+            state["search_entry"] = entry
+        return state["search_entry"]
+
+    def weights_changed(self):
+        self.weights_version += 1
+
+    def get_cached_placements(self, state):
+        entry = self.get_search_entry(state)
+
+        if entry["placements"] is None:
+            phase_start = self.stats.start()
+            entry["placements"] = self.get_legal_placements(state)
+            self.stats.stop("candidate_generation", phase_start)
+
+        return entry["placements"]
+
+    def get_shuffled_placements(self, state):
+        entry = self.get_search_entry(state)
+
+        if entry["shuffled_placements"] is None:
+            placements = self.get_cached_placements(state)
+            entry["shuffled_placements"] = self.rng.sample(placements, len(placements))
+
+        return entry["shuffled_placements"]
+
+    # The successor state, features and last Q-value of a placement from a
+    # state, as [successor state, features, weights version, Q-value], made
+    # once while the state stays in the transposition table. Features are
+    # only extracted when asked for, and the Q-value is only valid while
+    # weights_version matches. Callers must not change the returned state.
+    def get_successor_record(self, state, placement):
+        successors = self.get_search_entry(state)["successors"]
+
+        if placement not in successors:
+            if self.stats.enabled: self.stats.count("successors_built")
+            successors[placement] = [self.place_stone(state, placement), None, None, None]
+        elif self.stats.enabled:
+            self.stats.count("successor_cache_hits")
+
+        return successors[placement]
+
+    def get_placement_successor(self, state, placement):
+        return self.get_successor_record(state, placement)[0]
+
+    def get_successor_and_features(self, state, placement):
+        record = self.get_successor_record(state, placement)
+
+        if record[1] is None:
+            record[1] = self.extract_features(state, record[0])
+
+        return record[:2]
+
+    def place_stone(self, state, placement):
+        successor_state = self.copy_state(state)
+        successor_state["stone"] = rotated_shape(state["stone"], placement_rotations(placement))
+        successor_state["stone_x"] = placement_column(placement)
+
+        self.drop_stone(successor_state)
+        return successor_state
 
-        successor_state = self.get_successor_state(state, action_sequence)
-        features = self.extract_features(state, successor_state)
+    def get_q_value(self, state, placement):
+        record = self.get_successor_record(state, placement)
 
-        for feature, value in features.iteritems():
-            q_value += self.weights[feature] * value
+        if record[2] != self.weights_version:
+            successor_state, features = self.get_successor_and_features(state, placement)
 
-        return q_value
+            record[2] = self.weights_version
+            record[3] = float(features.dot(self.weights))
 
+        return record[3]
+
+    def evaluate(self, state, successor_states):
+        if self.evaluator:
+            return self.evaluator(state, successor_states)
+        elif self.batch_evaluation:
+            return self.get_q_values(state, successor_states)
+        else:
+            return [self.get_state_q_value(state, successor_state) for successor_state in successor_states]
+
+    def get_state_q_value(self, state, successor_state):
+        return float(self.extract_features(state, successor_state).dot(self.weights))
+
+    def get_q_values(self, state, successor_states):
+        if not successor_states: return []
+        if not self.features_batchable:
+            return [self.get_state_q_value(state, successor_state) for successor_state in successor_states]
+
+        successor_boards = [successor_state["board"] for successor_state in successor_states]
+        features = tetris_batch_features.extract_features(state["board"], successor_boards)
+        q_values = self.get_batch_feature_matrix(features).dot(self.weights)
+
+        if self.check_batch_evaluation:
+            for successor_state, q_value in zip(successor_states, q_values):
+                assert q_value == self.get_state_q_value(state, successor_state)
+
+        return q_values.tolist()
+
+    # The features of tetris_batch_features, one column per feature in use
+    def get_batch_feature_matrix(self, features):
+        return np.column_stack([features[feature] for feature in self.feature_names]).astype(float)
+
+    def get_profile(self, state):
+        if "profile" not in state:
+            state["profile"] = get_board_profile(state["board"])
+        return state["profile"]
+
+    # Switches to the named features, keeping the weights of the ones
+    # already in use and starting the others at 0
+    def use_features(self, names):
+        named_weights = self.get_named_weights()
+
+        self.feature_names = tuple(names)
+        self.feature_index = dict((name, index) for index, name in enumerate(self.feature_names))
+        self.weights = np.array([named_weights.get(name, 0.0) for name in self.feature_names])
+        self.feature_computes = [tetris_features.feature_registry[name].compute
+                                 for name in self.feature_names]
+        self.feature_needs = tetris_features.feature_needs(self.feature_names)
+        self.features_need_scan = not self.feature_needs <= tetris_features.profile_intermediates
+        self.features_batchable = set(self.feature_names) <= tetris_batch_features.feature_names
+        self.weights_changed()
+        # Cached successors hold feature vectors of the old features
+        self.transposition_table.clear()
+
+    # The intermediates the features in use read, worked out once per state
+    def get_summary(self, state):
+        if not self.features_need_scan: return self.get_profile(state)
+
+        summary = state.get("summary")
+
+        if summary is None or summary[0] is not self.feature_needs:
+            summary = (self.feature_needs, tetris_features.summarize(
+                state["board"], self.get_profile(state), state.get("cleared_rows", 0), self.feature_needs))
+            state["summary"] = summary
+        return summary[1]
+
+    # The features of a successor state as a vector in feature_names order
     def extract_features(self, state, successor_state):
-        old_pile_height = self.get_pile_height(state)
-        new_pile_height = self.get_pile_height(successor_state)
-        change_in_pile_height = new_pile_height - old_pile_height
-
-        old_holes = self.get_holes(state)
-        new_holes = self.get_holes(successor_state)
-        change_in_holes = new_holes - old_holes
-
-        old_contours = self.get_contours(state)
-        new_contours = self.get_contours(successor_state)
-        change_in_contours = new_contours - old_contours
-
-        features = {
-            "CHANGE_IN_PILE_HEIGHT": change_in_pile_height,
-            "CHANGE_IN_HOLES": change_in_holes,
-            "CHANGE_IN_CONTOURS": change_in_contours
-        }
+        return np.array(self.get_feature_values(state, successor_state), dtype=float)
+
+    def get_feature_values(self, state, successor_state):
+        if self.features_need_scan:
+            old_summary = self.get_summary(state)
+            new_summary = self.get_summary(successor_state)
+        else:
+            old_summary = self.get_profile(state)
+            new_summary = self.get_profile(successor_state)
+
+        return [compute(old_summary, new_summary) for compute in self.feature_computes]
 
-        return features
+    def get_feature_dict(self, features):
+        return dict(izip(self.feature_names, features.tolist()))
 
     def get_contours(self, state):
         board = state["board"]
@@ -297,7 +522,7 @@ class TetrisReinforcementLearner:
 
         column_height = self.get_column_pile_height(board, 0)
 
-        for col_idx in xrange(1, len(board[0])):
+        for col_idx in xrange(1, board_width(board)):
             next_column_height = self.get_column_pile_height(board, col_idx)
             height_difference = abs(next_column_height - column_height)
             column_height = next_column_height
@@ -308,13 +533,12 @@ class TetrisReinforcementLearner:
 
     def get_column_pile_height(self, board, col_index):
         board_height = len(board) - 1
+        column_mask = 1 << col_index
         height = 0
         pile_height = 0
 
         while height < board_height:
-            row = board[height]
-
-            if self.row_has_piece([row[col_index]]):
+            if board[height] & column_mask:
                 pile_height = board_height - height
                 break;
             height += 1
@@ -334,7 +558,7 @@ class TetrisReinforcementLearner:
                 cell_height += len(board) - 1 - row_index
                 row_index += 1
 
-            self.maximum_cell_height = cell_height * len(board[0])
+            self.maximum_cell_height = cell_height * board_width(board)
             return self.maximum_cell_height
 
 
@@ -345,60 +569,25 @@ class TetrisReinforcementLearner:
         copied_state = self.copy_state(state)
         self.drop_stone(copied_state)
 
-        board = copied_state['board']
-        height_weighted_cells = 0
-
-        for row_index, row in enumerate(board):
-            if row_index + 1 == len(board): continue
-            height_weighted_value = len(board) - 1 - row_index
-
-            for col_index, square in enumerate(row):
-                if square > 0: height_weighted_cells += height_weighted_value
+        row_fills = tetris_features.scan_board(copied_state["board"], ["row_fills"])[0]
+        return tetris_features.height_weighted_cells(row_fills)
 
-        return height_weighted_cells
 
 
-
-    def get_holes_at_square(self, board, row_index, col_index):
-        row_index += 1
-        holes_at_square = 1
-
-        while row_index < len(board) - 1:
-            if board[row_index][col_index] == 0:
-                holes_at_square += 1
-                row_index += 1
-            else:
-                break
-
-        return holes_at_square
-
     def get_holes(self, state):
         board = state['board']
         holes = 0
+        # Columns that have a filled square somewhere above the current row
+        covered = 0
 
-        for row_index, row in enumerate(board):
-            if row_index == 0: continue
-            for col_index, square in enumerate(row):
-                if square == 0 and board[row_index - 1][col_index] > 0:
-                    holes += self.get_holes_at_square(board, row_index, col_index)
+        for row in board[:-1]:
+            holes += count_cells(covered & ~row)
+            covered |= row
 
         return holes
 
-    def get_normalized_pile_height_if_dropped(self, state):
-        height = self.get_pile_height_if_dropped(state)
-        return height
-
-
-    def get_pile_height_if_dropped(self, state):
-        copied_state = self.copy_state(state)
-        self.drop_stone(copied_state)
-
-        pile_height = self.get_pile_height(copied_state)
-
-        return pile_height
-
     def row_has_piece(self, row):
-        return [square for square in row if square > 0]
+        return row > 0
 
     def get_pile_height(self, state):
         board = state["board"]
@@ -412,111 +601,81 @@ class TetrisReinforcementLearner:
         return pile_height
 
     def drop_stone(self, state):
-        while not check_collision(state["board"], state["stone"], (state["stone_x"], state["stone_y"])):
-            state["stone_y"] += 1
-
-        join_matrixes(state["board"], state["stone"], (state["stone_x"], state["stone_y"]))
-        if state["next_stone"]: self.move_to_next_stone(state)
-        board = state["board"]
-
-        while True:
-            for i, row in enumerate(board[:-1]):
-                if 0 not in row:
-                    state["board"] = remove_row(board, i)
-                    break
-            else:
-                break
-
-
-    def get_cleared_rows(self, state):
-        copied_state = self.copy_state(state)
-        offset = (copied_state["stone_x"], copied_state["stone_y"])
-
-        joined_board = join_matrixes(copied_state["board"], copied_state["stone"], offset)
-
-        cleared_rows = 0
-        for i, row in enumerate(joined_board[:-1]):
-            if 0 not in row: cleared_rows += 1
-
-        return cleared_rows
-
-    def get_successor_state(self, state, action_sequence):
-        successor_state = self.copy_state(state)
-
-        for action in action_sequence:
-            if action == 'LEFT':
-                self.move(successor_state, -1)
-            elif action == 'RIGHT':
-                self.move(successor_state, 1)
-            elif action == 'UP':
-                self.rotate(successor_state)
-            elif action == 'NEXT_STONE':
-                self.drop_stone(successor_state)
-
-        self.drop_stone(successor_state)
-
-        return successor_state
+        state["board"], state["profile"], cleared_rows = drop_shape(state["board"], self.get_profile(state), state["stone"], state["stone_x"], state["stone_y"])
+        state["cleared_rows"] = state.get("cleared_rows", 0) + cleared_rows
+        state.pop("summary", None)
+        if state["next_stone"]:
+            self.move_to_next_stone(state)
+        else:
+            state["stone"] = None
 
     def copy_state(self, state):
         return {
-            "board": deepcopy(state["board"]),
+            "board": state["board"],
+            "profile": self.get_profile(state),
             "stone": state["stone"],
             "next_stone": state["next_stone"],
             "stone_x": state["stone_x"],
             "stone_y": state["stone_y"],
-            "gameover": state["gameover"]
+            "gameover": state["gameover"],
+            # Rows cleared since the state the search started from
+            "cleared_rows": state.get("cleared_rows", 0)
         }
 
 
-    def move(self, state, direction):
-        new_x = state["stone_x"] + direction
-        board_length = len(state["board"])
-        stone_length = len(state["stone"][0])
+    # A move that lost the game leads to a state worth nothing, so nothing is
+    # searched from it and only its gameover flag is read
+    def update(self, state, placement, new_state, reward):
+        phase_start = self.stats.start()
+        old_state_value = self.get_q_value(state, placement)
 
-        if new_x < 0: new_x = 0
-        if new_x >= board_length - stone_length:
-            new_x = board_length - stone_length
-        if not check_collision(state["board"],
-                               state["stone"],
-                               (new_x, state["stone_y"])):
-            state["stone_x"] = new_x
-
-    def rotate(self, state):
-        new_stone = rotate_clockwise(state["stone"])
-        if not check_collision(state["board"],
-                               new_stone,
-                               (state["stone_x"], state["stone_y"])):
-            state["stone"] = new_stone
-
-    def drop(self, state):
-        state["stone_y"] += 1
-
-    def join_action_sequence(self, action_sequence):
-        two_action_sequences_happened = isinstance(action_sequence[0], list)
-
-        if two_action_sequences_happened:
-            return action_sequence[0] + ["NEXT_STONE"] + action_sequence[1]
+        if new_state["gameover"]:
+            new_state_max_q, new_state_placement = 0, None
         else:
-            return action_sequence
-
-    def update(self, state, action_sequence, new_state, reward):
-        action_sequence = self.join_action_sequence(action_sequence)
-        old_state_value = self.get_q_value(state, action_sequence)
-        new_state_max_q = self.get_max_q_value(new_state)
+            new_state_max_q, new_state_placement = self.get_root_q_value_pair(new_state)
 
         new_state_value = reward + self.discount * new_state_max_q
         temporal_difference = new_state_value - old_state_value
 
-        old_successor_state = self.get_successor_state(state, action_sequence)
-
-        features = self.extract_features(state, old_successor_state)
+        old_successor_state, features = self.get_successor_and_features(state, placement)
+        self.weights = (1 - self.alpha) * self.weights + self.alpha * (temporal_difference * features)
 
-        for feature, value in features.iteritems():
-            new_value = temporal_difference * value
-            old_weight = self.weights[feature]
-            new_weight = (1 - self.alpha) * old_weight + self.alpha * new_value
-
-            self.weights[feature] = new_weight
+        if self.replay_buffer is not None:
+            if new_state["gameover"]:
+                next_features = np.zeros(len(self.feature_names))
+            else:
+                next_features = self.get_successor_and_features(new_state, new_state_placement)[1]
+            self.replay_buffer.add(features, reward, next_features, new_state["gameover"])
+            self.replay()
+
+        if self.alpha: self.weights_changed()
+        self.stats.stop("td_update", phase_start)
+
+    # One TD update from a mini-batch of the replay buffer, all at once. The
+    # value of each next state is that of its stored best placement under the
+    # current weights, one stone ahead.
+    def replay(self):
+        if len(self.replay_buffer) < self.replay_batch_size: return
+
+        indexes, importance = self.replay_buffer.sample(self.replay_batch_size)
+        features, rewards, next_features, done = self.replay_buffer.batch(indexes)
+
+        temporal_differences = self.update_batch(features, rewards, next_features, done, importance)
+        self.replay_buffer.update_priorities(indexes, temporal_differences)
+
+    # One TD update from a batch of transitions, one per row of features,
+    # with the update rule of update() averaged over the batch. The value of
+    # each next state is that of the best placement whose features are in
+    # next_features, and 0 where done. importance weighs the transitions.
+    # Returns the TD errors.
+    def update_batch(self, features, rewards, next_features, done, importance=1):
+        new_state_values = rewards + self.discount * np.where(done, 0, next_features.dot(self.weights))
+        temporal_differences = new_state_values - features.dot(self.weights)
+        new_values = (importance * temporal_differences).dot(features) / len(features)
+        self.weights = (1 - self.alpha) * self.weights + self.alpha * new_values
+
+        if self.alpha: self.weights_changed()
+        return temporal_differences
 
 
 
@@ -0,0 +1,102 @@
+import numpy as np
+
+# A fixed-capacity ring buffer of the learner's transitions: the features of
+# the placement made, the reward, the features of the best placement from the
+# state it led to and whether the game ended there. Each transition is one
+# record of a preallocated array, which can be an np.memmap file so buffers
+# of millions of transitions stay out of memory. The newest transitions
+# overwrite the oldest once it is full.
+#
+# Sampling is uniform, or prioritized by the size of each transition's last
+# TD error, with the priorities in a sum tree so drawing a batch and updating
+# its priorities take log(capacity) vectorized steps.
+class ReplayBuffer(object):
+    def __init__(self, capacity, feature_names, path=None, prioritized=False,
+                 priority_exponent=0.6, importance_exponent=0.4, seed=None):
+        self.capacity = capacity
+        self.feature_names = tuple(feature_names)
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.importance_exponent = importance_exponent
+        self.random_state = np.random.RandomState(seed)
+
+        record = np.dtype([
+            ("features", np.float64, (len(self.feature_names),)),
+            ("reward", np.float64),
+            ("next_features", np.float64, (len(self.feature_names),)),
+            ("done", np.bool_)
+        ])
+        if path is None:
+            self.transitions = np.zeros(capacity, dtype=record)
+        else:
+            self.transitions = np.memmap(path, dtype=record, mode="w+", shape=(capacity,))
+
+        self.position = 0
+        self.count = 0
+
+        # Leaves start at tree_size; node i sums nodes 2i and 2i + 1
+        self.tree_size = 1
+        while self.tree_size < capacity: self.tree_size *= 2
+        self.priority_tree = np.zeros(2 * self.tree_size)
+        self.max_priority = 1.0
+
+    def __len__(self):
+        return self.count
+
+    # features and next_features are vectors in feature_names order, like the
+    # learner's extract_features
+    def add(self, features, reward, next_features, done):
+        self.transitions[self.position] = (features, reward, next_features, done)
+
+        if self.prioritized:
+            self.set_priorities(np.array([self.position]), np.array([self.max_priority]))
+
+        self.position = (self.position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    # Indexes of batch_size transitions and the importance weight of each,
+    # which corrects the TD updates for prioritized sampling and is 1 for
+    # uniform sampling
+    def sample(self, batch_size):
+        if not self.prioritized:
+            return self.random_state.randint(self.count, size=batch_size), np.ones(batch_size)
+
+        total = self.priority_tree[1]
+        targets = self.random_state.uniform(0, total, size=batch_size)
+        nodes = np.ones(batch_size, dtype=np.int64)
+
+        while nodes[0] < self.tree_size:
+            left = 2 * nodes
+            go_right = targets >= self.priority_tree[left]
+            targets = np.where(go_right, targets - self.priority_tree[left], targets)
+            nodes = left + go_right
+
+        # Rounding can walk off the filled leaves into empty ones
+        indexes = np.minimum(nodes - self.tree_size, self.count - 1)
+        probabilities = self.priority_tree[indexes + self.tree_size] / total
+        importance = (self.count * probabilities) ** -self.importance_exponent
+        return indexes, importance / importance.max()
+
+    def batch(self, indexes):
+        transitions = self.transitions[indexes]
+        return (transitions["features"], transitions["reward"],
+                transitions["next_features"], transitions["done"])
+
+    def update_priorities(self, indexes, temporal_differences):
+        if not self.prioritized: return
+
+        priorities = (np.abs(temporal_differences) + 1e-6) ** self.priority_exponent
+        self.set_priorities(indexes, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+    def set_priorities(self, indexes, priorities):
+        nodes = indexes + self.tree_size
+        self.priority_tree[nodes] = priorities
+
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.priority_tree[nodes] = self.priority_tree[2 * nodes] + self.priority_tree[2 * nodes + 1]
+
+    def flush(self):
+        if isinstance(self.transitions, np.memmap):
+            self.transitions.flush()
@@ -0,0 +1,76 @@
+import cProfile, json, time
+
+from collections import defaultdict
+
+# Where the agent's time goes, per phase, plus counters of the search's
+# work. It is off unless enabled, and then costs one attribute check per
+# phase. Phases can nest: lookahead includes generating the candidates of
+# the stones it looks at, and td_update includes the search for the next
+# state's best value.
+class AgentStats(object):
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.output = None
+        self.export_every = 0
+        self.reset()
+
+    def reset(self):
+        self.phase_seconds = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.placements = 0
+        self.start_time = time.time()
+
+    # Starts timing a phase, returning what stop() needs or None when off
+    def start(self):
+        if self.enabled: return time.time()
+
+    def stop(self, phase, start):
+        if start is not None:
+            self.phase_seconds[phase] += time.time() - start
+            self.phase_calls[phase] += 1
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    # Writes the stats of the last export_every placements as one JSON line
+    # to output, a file-like object, and starts counting again
+    def export_to(self, output, export_every):
+        self.enabled = True
+        self.output = output
+        self.export_every = export_every
+        self.reset()
+
+    def placement_done(self, reinforcement_learner):
+        if not self.enabled: return
+
+        self.placements += 1
+        if self.output and self.placements >= self.export_every:
+            self.output.write(json.dumps(self.summary(reinforcement_learner), sort_keys=True) + "\n")
+            self.output.flush()
+            self.reset()
+
+    def summary(self, reinforcement_learner):
+        elapsed = time.time() - self.start_time
+        transposition_table = reinforcement_learner.transposition_table
+
+        return {
+            "time": time.time(),
+            "placements": self.placements,
+            "seconds": elapsed,
+            "placements_per_second": self.placements / elapsed if elapsed else 0.0,
+            "phase_seconds": dict(self.phase_seconds),
+            "phase_calls": dict(self.phase_calls),
+            "counters": dict(self.counters),
+            "transposition_entries": len(transposition_table),
+            "transposition_hit_rate": transposition_table.hit_rate()
+        }
+
+# Runs function(*args) under cProfile and writes the profile to path, for
+# reading with pstats or snakeviz
+def profile_run(path, function, *args):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args)
+    finally:
+        profiler.dump_stats(path)
@@ -1,26 +1,404 @@
-def check_collision(board, shape, offset):
+from collections import namedtuple, OrderedDict
+
+import random
+
+# Boards are bitboards: a tuple of ints, one per row, top row first. Bit x of
+# a row is set when column x is filled. The last row is a solid floor, so its
+# value doubles as the full-row mask and carries the board width. Boards are
+# never changed in place, so states can share them instead of copying.
+
+# Define the shapes of the single parts. They are tuples so every rotation
+# can key the piece table below.
+tetris_shapes = [
+    ((1, 1, 1),
+     (0, 1, 0)),
+
+    ((0, 2, 2),
+     (2, 2, 0)),
+
+    ((3, 3, 0),
+     (0, 3, 3)),
+
+    ((4, 0, 0),
+     (4, 4, 4)),
+
+    ((0, 0, 5),
+     (5, 5, 5)),
+
+    ((6, 6, 6, 6),),
+
+    ((7, 7),
+     (7, 7))
+]
+
+def empty_board(cols, rows):
+    return (0,) * rows + ((1 << cols) - 1,)
+
+def board_width(board):
+    return board[-1].bit_length()
+
+def count_cells(row):
+    return bin(row).count("1")
+
+def shape_masks(shape):
+    return [sum(1 << cx for cx, cell in enumerate(row) if cell)
+            for row in shape]
+
+def masks_collide(board, masks, offset):
     off_x, off_y = offset
-    for cy, row in enumerate(shape):
-        for cx, cell in enumerate(row):
-            try:
-                if cell and board[ cy + off_y ][ cx + off_x ]:
-                    return True
-            except IndexError:
+    if off_x < 0:
+        return True
+    walls = ~board[-1]
+    for cy, mask in enumerate(masks):
+        try:
+            if (mask << off_x) & (board[ cy + off_y ] | walls):
                 return True
+        except IndexError:
+            return True
     return False
 
-def join_matrixes(mat1, mat2, mat2_off):
-    off_x, off_y = mat2_off
-    for cy, row in enumerate(mat2):
-        for cx, val in enumerate(row):
-            mat1[cy+off_y-1 ][cx+off_x] += val
-    return mat1
+def check_collision(board, shape, offset):
+    return masks_collide(board, piece_geometry(shape).masks, offset)
+
+def join_matrixes(board, shape, offset):
+    off_x, off_y = offset
+    joined = list(board)
+    for cy, mask in enumerate(piece_geometry(shape).masks):
+        joined[cy+off_y-1] |= mask << off_x
+    return tuple(joined)
 
 def rotate_clockwise(shape):
-    return [ [ shape[y][x]
-            for y in xrange(len(shape)) ]
-        for x in xrange(len(shape[0]) - 1, -1, -1) ]
+    return piece_geometry(shape).clockwise
+
+def full_rows(board):
+    full = board[-1]
+    return [i for i, row in enumerate(board[:-1]) if row == full]
 
 def remove_row(board, row):
-    del board[row]
-    return [[0 for i in xrange(len(board[0]))]] + board
+    return (0,) + board[:row] + board[row+1:]
+
+# Removes several rows at once, shifting everything above them down
+def remove_rows(board, rows):
+    kept = tuple(row for y, row in enumerate(board[:-1]) if y not in rows)
+    return (0,) * (len(board) - 1 - len(kept)) + kept + board[-1:]
+
+def shape_key(shape):
+    return tuple(tuple(row) for row in shape)
+
+def clockwise_shape(shape):
+    return tuple(tuple(shape[y][x] for y in xrange(len(shape)))
+                 for x in xrange(len(shape[0]) - 1, -1, -1))
+
+# For each shape column, the index of its highest and lowest filled square
+def column_top_cells(shape):
+    return tuple(min(cy for cy, row in enumerate(shape) if row[cx])
+                 for cx in xrange(len(shape[0])))
+
+def column_bottoms(shape):
+    return tuple(max(cy for cy, row in enumerate(shape) if row[cx])
+                 for cx in xrange(len(shape[0])))
+
+# Everything the game and the search need to know about one rotation of a
+# piece: its width, row masks, column tops and bottoms, the (x, y) offsets
+# of its squares, the shape one clockwise turn further and its rotation
+# table. The rotation table lists the distinct rotations in the order the UP
+# key reaches them, as (rotations, rotated shape, row masks, column
+# bottoms). Rotations that give a shape already in the table (the O stone,
+# the second half of the I, S and Z stones) are left out.
+PieceGeometry = namedtuple("PieceGeometry",
+    "shape width masks tops bottoms cells clockwise rotations")
+
+piece_table = {}
+
+# Adds every rotation of a shape to the piece table
+def add_piece(shape):
+    orientations = [shape_key(shape)]
+    for turns in xrange(3):
+        orientations.append(clockwise_shape(orientations[-1]))
+
+    geometries = {}
+    for orientation in orientations:
+        geometries[orientation] = (
+            tuple(shape_masks(orientation)), column_top_cells(orientation),
+            column_bottoms(orientation))
+
+    for index, orientation in enumerate(orientations):
+        masks, tops, bottoms = geometries[orientation]
+        rotations = []
+        seen = set()
+        for turns in xrange(4):
+            rotated = orientations[(index + turns) % 4]
+            if rotated not in seen:
+                seen.add(rotated)
+                rotated_masks, rotated_tops, rotated_bottoms = geometries[rotated]
+                rotations.append((turns, rotated, rotated_masks, rotated_bottoms))
+
+        piece_table[orientation] = PieceGeometry(
+            orientation, len(orientation[0]), masks, tops, bottoms,
+            tuple((cx, cy) for cy, row in enumerate(orientation)
+                  for cx, cell in enumerate(row) if cell),
+            orientations[(index + 1) % 4], rotations)
+
+    return piece_table[orientations[0]]
+
+# Shapes other than the rotations of tetris_shapes (or given as lists) are
+# converted and added the first time they are looked up
+def piece_geometry(shape):
+    try:
+        return piece_table[shape]
+    except (KeyError, TypeError):
+        key = shape_key(shape)
+        return piece_table[key] if key in piece_table else add_piece(key)
+
+def build_piece_table(shapes):
+    for shape in shapes:
+        add_piece(shape)
+
+build_piece_table(tetris_shapes)
+
+def rotation_table(shape):
+    return piece_geometry(shape).rotations
+
+# The shape after rotating it clockwise the given number of times. Shapes
+# repeat after as many rotations as they have distinct ones.
+def rotated_shape(shape, rotations):
+    table = rotation_table(shape)
+    return table[rotations % len(table)][1]
+
+# Index of the highest filled row in each column (the floor if empty)
+def column_tops(board):
+    cols = board_width(board)
+    tops = [len(board) - 1] * cols
+    remaining = board[-1]
+    for y, row in enumerate(board[:-1]):
+        found = row & remaining
+        if found:
+            for x in xrange(cols):
+                if found >> x & 1:
+                    tops[x] = y
+            remaining &= ~found
+            if not remaining:
+                break
+    return tops
+
+def landing_row(tops, bottoms, x):
+    return min(tops[x + cx] - bottom
+               for cx, bottom in enumerate(bottoms)) - 1
+
+# landing_row assumes the stone falls in from above its columns' tops. A
+# stone that already hangs below an overhang has to fall row by row instead.
+def fall_row(board, masks, x, y):
+    while not masks_collide(board, masks, (x, y + 1)):
+        y += 1
+    return y
+
+# A placement packs how often a stone is rotated and the column its left
+# edge is dropped from into one small int, so candidates cost no allocation
+# and hash and compare as ints. Only the UI edge turns them into key presses.
+def pack_placement(rotations, column):
+    return column << 2 | rotations
+
+def placement_rotations(placement):
+    return placement & 3
+
+def placement_column(placement):
+    return placement >> 2
+
+def placement_actions(placement, stone_x):
+    delta = placement_column(placement) - stone_x
+    direction = "LEFT" if delta < 0 else "RIGHT"
+    return ["UP"] * placement_rotations(placement) + [direction] * abs(delta)
+
+# Every distinct resting place of a stone spawned at (stone_x, stone_y) as a
+# packed placement. Only rotations and columns reachable from the spawn point
+# without colliding are included, in the same order the move keys would
+# reach them.
+def get_placements(board, shape, stone_x, stone_y):
+    placements = []
+    for rotations, rotated, masks, bottoms in rotation_table(shape):
+        if masks_collide(board, masks, (stone_x, stone_y)):
+            break
+
+        x = stone_x
+        while x >= 0 and not masks_collide(board, masks, (x, stone_y)):
+            placements.append(x << 2 | rotations)
+            x -= 1
+
+        x = stone_x + 1
+        while not masks_collide(board, masks, (x, stone_y)):
+            placements.append(x << 2 | rotations)
+            x += 1
+    return placements
+
+# Zobrist hashing: a board hashes to the XOR of one random key per (row,
+# row value), so changing a row only swaps that row's key. Stones get a key
+# per shape and role so states with different stones hash apart. The keys
+# come from fixed seeds and are the same in every process.
+zobrist_row_tables = {}
+
+def zobrist_rows(rows, cols):
+    if (rows, cols) not in zobrist_row_tables:
+        generator = random.Random(rows * 1000003 + cols)
+        zobrist_row_tables[(rows, cols)] = [
+            [generator.getrandbits(64) for value in xrange(1 << cols)]
+            for y in xrange(rows)]
+    return zobrist_row_tables[(rows, cols)]
+
+def zobrist_board(board):
+    keys = zobrist_rows(len(board) - 1, board_width(board))
+    board_hash = 0
+    for y, row in enumerate(board[:-1]):
+        board_hash ^= keys[y][row]
+    return board_hash
+
+zobrist_stone_keys = {}
+
+def zobrist_stone(role, shape):
+    if shape is None:
+        return 0
+    key = (role, piece_geometry(shape).shape)
+    if key not in zobrist_stone_keys:
+        zobrist_stone_keys[key] = random.Random(repr(key)).getrandbits(64)
+    return zobrist_stone_keys[key]
+
+# Pile height and hole count of every column, plus the board totals the
+# learner's features are built from and the board's Zobrist hash. Dropping a
+# stone updates a profile through drop_shape, so only a new board has to be
+# scanned in full.
+BoardProfile = namedtuple("BoardProfile",
+    "column_heights column_holes pile_height holes contours zobrist")
+
+def make_profile(column_heights, column_holes, zobrist):
+    contours = sum(abs(column_heights[x] - column_heights[x - 1])
+                   for x in xrange(1, len(column_heights)))
+    return BoardProfile(column_heights, column_holes, max(column_heights),
+                        sum(column_holes), contours, zobrist)
+
+def column_profile(board, x):
+    board_height = len(board) - 1
+    mask = 1 << x
+    height = 0
+    holes = 0
+    for y in xrange(board_height):
+        if board[y] & mask:
+            if not height:
+                height = board_height - y
+        elif height:
+            holes += 1
+    return height, holes
+
+def get_board_profile(board):
+    columns = [column_profile(board, x) for x in xrange(board_width(board))]
+    return make_profile(tuple(height for height, holes in columns),
+                        tuple(holes for height, holes in columns),
+                        zobrist_board(board))
+
+# Drops a shape straight down from (x, y) and clears any rows it fills.
+# Returns the new board, its profile and the number of cleared rows. The
+# landing row comes from the profile's column heights, and only the columns
+# under the stone and the rows it lands on are looked at unless rows clear.
+def drop_shape(board, profile, shape, x, y):
+    board_height = len(board) - 1
+    piece = piece_geometry(shape)
+    masks, tops, bottoms = piece.masks, piece.tops, piece.bottoms
+    heights = list(profile.column_heights)
+    holes = list(profile.column_holes)
+
+    landing_y = min(board_height - heights[x + cx] - bottom
+                    for cx, bottom in enumerate(bottoms)) - 1
+    if landing_y < y:
+        if masks_collide(board, masks, (x, y)):
+            # The stone already collides where it is (the game is over), so
+            # it is joined one row up like join_matrixes does
+            board = join_matrixes(board, shape, (x, y))
+            cleared = 0
+        else:
+            # The stone hangs under an overhang
+            board = join_matrixes(board, shape, (x, fall_row(board, masks, x, y) + 1))
+            cleared = len(full_rows(board))
+        board = remove_rows(board, full_rows(board))
+        return board, get_board_profile(board), cleared
+
+    rows = list(board)
+    zobrist = profile.zobrist
+    keys = zobrist_rows(board_height, len(heights))
+    for cy, mask in enumerate(masks):
+        row = landing_y + cy
+        zobrist ^= keys[row][rows[row]]
+        rows[row] |= mask << x
+        zobrist ^= keys[row][rows[row]]
+
+    pile_height = profile.pile_height
+    total_holes = profile.holes
+    contours = profile.contours
+    for cx in xrange(len(bottoms)):
+        column = x + cx
+        old_top = board_height - heights[column]
+        new_holes = old_top - (landing_y + bottoms[cx]) - 1
+        holes[column] += new_holes
+        total_holes += new_holes
+        heights[column] = board_height - (landing_y + tops[cx])
+        pile_height = max(pile_height, heights[column])
+
+    full = board[-1]
+    cleared = [landing_y + cy for cy in xrange(len(masks))
+               if rows[landing_y + cy] == full]
+    if cleared:
+        for i in cleared:
+            del rows[i]
+            rows.insert(0, 0)
+        board = tuple(rows)
+        for column in xrange(len(heights)):
+            if board_height - heights[column] in cleared:
+                heights[column], holes[column] = column_profile(board, column)
+            else:
+                heights[column] -= len(cleared)
+        return (board,
+                make_profile(tuple(heights), tuple(holes), zobrist_board(board)),
+                len(cleared))
+
+    left = max(x - 1, 0)
+    right = min(x + len(bottoms), len(heights) - 1)
+    old_heights = profile.column_heights
+    for column in xrange(left, right):
+        contours += (abs(heights[column + 1] - heights[column]) -
+                     abs(old_heights[column + 1] - old_heights[column]))
+
+    return (tuple(rows),
+            BoardProfile(tuple(heights), tuple(holes), pile_height,
+                         total_holes, contours, zobrist),
+            0)
+
+# A bounded LRU map from position hashes to whatever the search stored for
+# them, counting how often a looked up position was already there
+class TranspositionTable(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        if key not in self.entries and len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,215 @@
+import numpy as np
+
+from tetris_utils import *
+
+# B games of tetris_game.TetrisGame in lockstep. The boards are one (B,
+# rows + 1) array of row bitmasks laid out like the tuples in tetris_utils,
+# floor row included, and every step drops one stone in every game at once:
+# landing rows, line clears, scores and rewards are all computed for the
+# whole batch with NumPy. Finished games are reset right away and carry on
+# with their next stone, the way TetrisGame.start_game does.
+#
+# drop_pieces is the kernel underneath, and the learner uses it to expand
+# and score the candidates of many positions in one call.
+
+# Row masks of every piece index and rotation count, padded to 4 rows, and
+# the width of each
+def build_piece_arrays():
+    masks = np.zeros((len(tetris_shapes), 4, 4), dtype=np.int64)
+    widths = np.zeros((len(tetris_shapes), 4), dtype=np.int64)
+
+    for piece, shape in enumerate(tetris_shapes):
+        for rotations in xrange(4):
+            geometry = piece_geometry(rotated_shape(shape, rotations))
+            masks[piece, rotations, :len(geometry.masks)] = geometry.masks
+            widths[piece, rotations] = geometry.width
+
+    return masks, widths
+
+piece_masks, piece_widths = build_piece_arrays()
+
+piece_indexes = dict((shape, piece) for piece, shape in enumerate(tetris_shapes))
+
+def spawn_columns(pieces, cols):
+    return cols // 2 - piece_widths[pieces, 0] // 2
+
+# Where each stone's rows would overlap the board or the floor, for every
+# row the stone's top could be at
+def collisions(boards, masks):
+    count, height = boards.shape
+    floor = boards[:, -1:]
+    padded = np.concatenate([boards, np.repeat(floor, 3, axis=1)], axis=1)
+
+    collide = np.zeros((count, height), dtype=bool)
+    for cy in xrange(4):
+        collide |= (padded[:, cy:cy + height] & masks[:, cy:cy + 1]) != 0
+    return collide
+
+# Drops stone i of pieces at rotations[i] straight down column columns[i]
+# of boards[i] from the top row, which it must fit in. Returns the boards
+# with the stones joined and the rows the stones landed on.
+def join_pieces(boards, pieces, rotations, columns):
+    count, height = boards.shape
+    masks = piece_masks[pieces, rotations] << columns[:, np.newaxis]
+
+    collide = collisions(boards, masks)
+    landing_rows = np.argmax(collide[:, 1:], axis=1)
+
+    # Padding rows of the masks are empty, so they may all point at the floor
+    rows = np.minimum(landing_rows[:, np.newaxis] + np.arange(4), height - 1)
+    joined = boards.copy()
+    joined[np.arange(count)[:, np.newaxis], rows] |= masks
+    return joined, landing_rows
+
+# Returns the boards without their full rows and how many each had
+def clear_full_rows(boards):
+    count, height = boards.shape
+    full = boards[:, :-1] == boards[:, -1:]
+    cleared = full.sum(axis=1)
+    if not cleared.any():
+        return boards, cleared
+
+    # A stable sort moves the full rows to the top in order, where they are
+    # emptied
+    order = np.argsort(~full, axis=1, kind="mergesort")
+    kept = boards[np.arange(count)[:, np.newaxis], order]
+    kept[np.arange(height - 1) < cleared[:, np.newaxis]] = 0
+
+    cleared_boards = boards.copy()
+    cleared_boards[:, :-1] = kept
+    return cleared_boards, cleared
+
+# join_pieces and clear_full_rows in one, also returning the landing rows
+def drop_pieces(boards, pieces, rotations, columns):
+    joined, landing_rows = join_pieces(boards, pieces, rotations, columns)
+    dropped, cleared = clear_full_rows(joined)
+    return dropped, landing_rows, cleared
+
+def pile_heights(boards):
+    filled = boards[:, :-1] != 0
+    height = boards.shape[1] - 1
+    return np.where(filled.any(axis=1), height - np.argmax(filled, axis=1), 0)
+
+class VectorTetrisEnv(object):
+    line_scores = np.array([0, 40, 100, 300, 1200])
+
+    # Stones are drawn from a NumPy RandomState seeded with seed, or dealt
+    # from a piece stream (see tetris_game.generate_pieces) with every game
+    # starting at its own offset
+    def __init__(self, games, cols=10, rows=22, seed=0, pieces=None):
+        self.games = games
+        self.cols = cols
+        self.rows = rows
+        self.random_state = np.random.RandomState(seed)
+        self.pieces = None if pieces is None else np.array(pieces, dtype=np.int64)
+        self.piece_indexes = np.arange(games) * (len(pieces) // games if pieces is not None else 0)
+        self.empty_board = np.array(empty_board(cols, rows), dtype=np.int64)
+        self.total_moves = 0
+
+        # A TetrisGame deals its first stone while it is built and then again
+        # when start_game() starts the first game, so that stone is skipped
+        self.deal(np.arange(games))
+        self.next_stones = self.deal(np.arange(games))
+        self.reset()
+
+    def deal(self, games):
+        if self.pieces is None:
+            return self.random_state.randint(len(tetris_shapes), size=len(games))
+
+        dealt = self.pieces[self.piece_indexes[games] % len(self.pieces)]
+        self.piece_indexes[games] += 1
+        return dealt
+
+    # Starts the given games (all by default) over on an empty board
+    def reset(self, games=None):
+        if games is None:
+            games = np.arange(self.games)
+            self.boards = np.tile(self.empty_board, (self.games, 1))
+            self.stones = np.zeros(self.games, dtype=np.int64)
+            self.scores = np.zeros(self.games, dtype=np.int64)
+            self.lines = np.zeros(self.games, dtype=np.int64)
+            self.levels = np.ones(self.games, dtype=np.int64)
+
+        self.boards[games] = self.empty_board
+        self.stones[games] = self.next_stones[games]
+        self.next_stones[games] = self.deal(games)
+        self.scores[games] = 0
+        self.lines[games] = 0
+        self.levels[games] = 1
+
+    # The games as the states TetrisReinforcementLearner expects
+    def states(self):
+        spawn = spawn_columns(self.stones, self.cols)
+
+        return [{
+            "board": tuple(int(row) for row in self.boards[game]),
+            "stone": tetris_shapes[self.stones[game]],
+            "next_stone": tetris_shapes[self.next_stones[game]],
+            "stone_x": int(spawn[game]),
+            "stone_y": 0,
+            "gameover": False
+        } for game in xrange(self.games)]
+
+    # Puts down one packed placement (see tetris_utils.pack_placement) per
+    # game, scoring like TetrisGame.apply_placement. Returns each game's
+    # reward (minus the change in pile height, as TetrisGame.update uses),
+    # which games ended, and the (score, lines) of every ended game. Ended
+    # games are reset.
+    def step(self, placements):
+        placements = np.asarray(placements, dtype=np.int64)
+        old_pile_heights = pile_heights(self.boards)
+
+        # The next stone spawns before full rows are cleared, so whether it
+        # fits is checked on the board with the stone just joined
+        joined, landing_rows = join_pieces(
+            self.boards, self.stones, placements & 3, placements >> 2)
+        boards, cleared = clear_full_rows(joined)
+
+        self.stones = self.next_stones
+        self.next_stones = self.deal(np.arange(self.games))
+        spawn_masks = piece_masks[self.stones, 0] << spawn_columns(self.stones, self.cols)[:, np.newaxis]
+        gameover = collisions(joined, spawn_masks)[:, 0]
+
+        self.boards = boards
+        self.scores += landing_rows + 1
+        self.lines += cleared
+        self.scores += self.line_scores[cleared] * self.levels
+        self.levels += self.lines >= self.levels * 6
+        self.total_moves += self.games
+
+        rewards = old_pile_heights - pile_heights(boards)
+        finished = [(int(self.scores[game]), int(self.lines[game]))
+                    for game in np.flatnonzero(gameover)]
+        if gameover.any():
+            self.reset(np.flatnonzero(gameover))
+
+        return rewards, gameover, finished
+
+# Plays placements moves in every game of env, choosing all the games'
+# moves with one batched call. Learning is batched too: each step is one TD
+# update over all the games, with every next state valued one stone ahead by
+# the best placement the next batched call finds, and ended games valued 0.
+# Returns the (score, lines) of every game that ended.
+def run_vectorized(reinforcement_learner, env, placements):
+    finished_games = []
+    chosen, features = reinforcement_learner.get_best_placements_batch(env.states())
+
+    for move in xrange(placements):
+        rewards, gameover, finished = env.step(chosen)
+        finished_games.extend(finished)
+        next_chosen, next_features = reinforcement_learner.get_best_placements_batch(env.states())
+
+        if reinforcement_learner.alpha:
+            replay_buffer = reinforcement_learner.replay_buffer
+            if replay_buffer is not None:
+                lost = np.zeros(features.shape[1])
+                for game in xrange(env.games):
+                    next_game_features = lost if gameover[game] else next_features[game]
+                    replay_buffer.add(features[game], rewards[game], next_game_features, gameover[game])
+                reinforcement_learner.replay()
+
+            reinforcement_learner.update_batch(features, rewards, next_features, gameover)
+
+        chosen, features = next_chosen, next_features
+
+    return finished_games